@@ -0,0 +1,91 @@
+"""
+wtController.bulk_add_nodes, batches of addnode messages to a stand-in Polyglot.
+"""
+import os,sys,time,threading,logging,unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# polyinterface reads the Polyglot config from stdin and takes over stdout
+# and stderr when it's imported.
+stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+sys.stdin = sys.__stdin__
+try:
+    from wt_nodes import wtController
+finally:
+    sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+
+class wtNode():
+
+    def __init__(self,address):
+        self.address = address
+        self.name    = 'Tag ' + address
+        self.id      = 'wTag'
+        self.primary = 'mgr'
+        self.hint    = None
+        self.drivers = [{ 'driver': 'ST', 'value': 0, 'uom': 2 }]
+        self.started = False
+        self.defer_reports = False
+        self.flushed = None
+
+    def flush_reports(self):
+        self.flushed = self.started
+        self.defer_reports = False
+
+class wtPoly():
+    """ Starts the nodes it's sent, like Polyglot does when it answers, except skip """
+
+    def __init__(self,nodes,skip=()):
+        self.nodes    = nodes
+        self.skip     = skip
+        self.messages = list()
+
+    def send(self,message):
+        self.messages.append(message)
+        addresses = [node['address'] for node in message['addnode']['nodes']]
+        def start():
+            time.sleep(0.05)
+            for address in addresses:
+                if address not in self.skip:
+                    self.nodes[address].started = True
+        threading.Thread(target=start,daemon=True).start()
+
+def make_controller(params,skip=()):
+    controller = wtController.__new__(wtController)
+    controller.id = 'wtController'
+    controller.polyConfig = { 'customParams': params }
+    controller.nodes = dict()
+    controller._nodes = { 't1': { 'drivers': [{ 'driver': 'ST', 'value': 7, 'uom': 2 }] } }
+    controller.nodesAdding = list()
+    controller.poly = wtPoly(controller.nodes,skip)
+    return controller
+
+class TestBulkAdd(unittest.TestCase):
+
+    def test_batches(self):
+        controller = make_controller({ 'add_batch': 2, 'add_rate': 100 })
+        nodes = [wtNode('t{0}'.format(i)) for i in range(5)]
+        self.assertEqual(controller.bulk_add_nodes(nodes),5)
+        self.assertEqual([[n['address'] for n in m['addnode']['nodes']] for m in controller.poly.messages],
+                         [['t0','t1'],['t2','t3'],['t4']])
+        # The value Polyglot had is kept.
+        self.assertEqual(nodes[1].drivers[0]['value'],7)
+        self.assertEqual(controller.nodesAdding,['t0','t1','t2','t3','t4'])
+        # Reports waited until they had all started.
+        self.assertEqual([node.flushed for node in nodes],[True] * 5)
+
+    def test_rate(self):
+        controller = make_controller({ 'add_batch': 2, 'add_rate': 20 })
+        stime = time.time()
+        controller.bulk_add_nodes([wtNode('t{0}'.format(i)) for i in range(4)])
+        # 4 nodes at 20 a second.
+        self.assertGreaterEqual(time.time() - stime,0.2)
+
+    def test_timeout(self):
+        controller = make_controller({ 'add_batch': 10, 'add_rate': 100, 'add_timeout': 0.5 },skip=('t2',))
+        nodes = [wtNode('t{0}'.format(i)) for i in range(3)]
+        stime = time.time()
+        self.assertEqual(controller.bulk_add_nodes(nodes),2)
+        self.assertLess(time.time() - stime,2)
+        # Reported anyway, after the timeout.
+        self.assertEqual([node.defer_reports for node in nodes],[False] * 3)
+
+if __name__ == '__main__':
+    unittest.main()
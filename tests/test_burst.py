@@ -0,0 +1,77 @@
+"""
+Collapsing bursts of motion and door events in wTag.get_handler.
+"""
+import os,sys,time,threading,logging,unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wt_trace
+from wt_trace import wtLatency
+# polyinterface reads the Polyglot config from stdin and takes over stdout
+# and stderr when it's imported.
+stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+sys.stdin = sys.__stdin__
+try:
+    from wt_nodes import wTag
+finally:
+    sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+
+logger = logging.getLogger('test_burst')
+
+class wtStub():
+    pass
+
+def make_tag(window=0.2):
+    controller = wtStub()
+    controller.store = None
+    controller.latency = wtLatency(logger)
+    controller.collapse_windows = { '/motion_detected': window, '/motion_timedout': window }
+    controller.collapse_stats = dict()
+    tag = wTag.__new__(wTag)
+    tag.controller = controller
+    tag.primary_n = wtStub()
+    tag.primary_n.wtServer = wtStub()
+    tag.primary_n.wtServer.rest = wtStub()
+    tag.primary_n.wtServer.rest.lock = threading.Lock()
+    tag.burst_lock = threading.Lock()
+    tag.burst_until = 0
+    tag.burst_pending = None
+    tag.burst_id = 0
+    tag.applied = list()
+    def apply_event(command,params):
+        trace = getattr(wt_trace.current,'trace',None)
+        tag.applied.append((command,params['n'],trace is not None))
+        return True
+    tag.apply_event = apply_event
+    return tag
+
+class TestBurst(unittest.TestCase):
+
+    def test_burst(self):
+        tag = make_tag()
+        for i in range(6):
+            self.assertTrue(tag.get_handler('/motion_detected' if i % 2 == 0 else '/motion_timedout',{ 'n': i }))
+        # Only the first is applied now.
+        self.assertEqual([a[1] for a in tag.applied],[0])
+        time.sleep(0.4)
+        # Then the last one when the window ends, traced like it came in then.
+        self.assertEqual(tag.applied,[('/motion_detected',0,False),('/motion_timedout',5,True)])
+        self.assertEqual(tag.controller.collapse_stats,{ 'motion_detected': 2, 'motion_timedout': 2 })
+        self.assertEqual(tag.controller.latency.get_stats()['dispatch']['count'],1)
+
+    def test_update_in_window(self):
+        # The waiting event is older than the update, so it goes first, not after it.
+        tag = make_tag()
+        tag.get_handler('/motion_detected',{ 'n': 0 })
+        tag.get_handler('/motion_timedout',{ 'n': 1 })
+        tag.get_handler('/update',{ 'n': 2 })
+        time.sleep(0.4)
+        self.assertEqual([a[:2] for a in tag.applied],[('/motion_detected',0),('/motion_timedout',1),('/update',2)])
+
+    def test_no_window(self):
+        tag = make_tag(window=0)
+        for i in range(3):
+            tag.get_handler('/motion_detected',{ 'n': i })
+        self.assertEqual([a[1] for a in tag.applied],[0,1,2])
+        self.assertEqual(tag.controller.collapse_stats,{})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+wtServer.api_read_d, calls running at the same time are sent once and
+results are reused for cache_ttl seconds.
+"""
+import os,sys,time,threading,logging,unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wtServer import wtServer
+
+logger = logging.getLogger('test_cache')
+
+def make_server(cache_ttl=5,delay=0):
+    server = wtServer(logger,'client','secret',cache_ttl=cache_ttl)
+    server.calls = list()
+    def api_post_d(path,payload,dump=True,mac=None):
+        server.calls.append((path,mac))
+        time.sleep(delay)
+        return { 'st': True, 'result': [len(server.calls)] }
+    server.api_post_d = api_post_d
+    return server
+
+class TestCache(unittest.TestCase):
+
+    def test_single_flight(self):
+        server = make_server(delay=0.2)
+        results = list()
+        threads = [threading.Thread(target=lambda: results.append(server.GetTagList('MAC1'))) for i in range(5)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(len(server.calls),1)
+        self.assertEqual(results,[{ 'st': True, 'result': [1] }] * 5)
+        self.assertEqual(server.get_cache_stats()['collapse'],4)
+        # Each got it's own copy.
+        self.assertIsNot(results[0]['result'],results[1]['result'])
+
+    def test_ttl(self):
+        server = make_server(cache_ttl=0.2)
+        self.assertEqual(server.GetTagList('MAC1')['result'],[1])
+        self.assertEqual(server.GetTagList('MAC1')['result'],[1])
+        time.sleep(0.3)
+        self.assertEqual(server.GetTagList('MAC1')['result'],[2])
+        self.assertEqual(server.get_cache_stats()['hit'],1)
+
+    def test_by_mac(self):
+        server = make_server()
+        server.GetTagList('MAC1')
+        server.GetTagList('MAC2')
+        self.assertEqual(server.calls,[('ethClient.asmx/GetTagList','MAC1'),('ethClient.asmx/GetTagList','MAC2')])
+
+    def test_cache_clear(self):
+        server = make_server()
+        server.GetTagList('MAC1')
+        server.cache_clear()
+        server.GetTagList('MAC1')
+        self.assertEqual(len(server.calls),2)
+
+    def test_failed_not_cached(self):
+        server = make_server()
+        server.api_post_d = lambda path, payload, dump=True, mac=None: server.calls.append(path) or { 'st': False }
+        server.GetTagList('MAC1')
+        server.GetTagList('MAC1')
+        self.assertEqual(len(server.calls),2)
+
+    def test_select_ttl(self):
+        server = make_server()
+        server.select_ttl = 0.2
+        server.SelectTagManager('MAC1')
+        server.SelectTagManager('MAC1')
+        self.assertEqual(len(server.calls),1)
+        time.sleep(0.3)
+        server.SelectTagManager('MAC1')
+        self.assertEqual(len(server.calls),2)
+        # Selecting fails, so the next one has to ask again.
+        server.api_post_d = lambda path, payload, dump=True, mac=None: server.calls.append(path) or { 'st': False }
+        server.selected_time = 0
+        self.assertFalse(server.SelectTagManager('MAC1')['st'])
+        self.assertIsNone(server.last_selected)
+
+if __name__ == '__main__':
+    unittest.main()
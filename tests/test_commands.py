@@ -0,0 +1,125 @@
+"""
+ISY commands run on the task workers, in order for each tag.
+"""
+import os,sys,time,threading,logging,unittest
+from functools import partial
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wt_tasks import wtTaskExecutor
+# polyinterface reads the Polyglot config from stdin and takes over stdout
+# and stderr when it's imported.
+stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+sys.stdin = sys.__stdin__
+try:
+    from wt_nodes import wTag,wtController
+finally:
+    sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+
+logger = logging.getLogger('test_commands')
+
+class wtStub():
+    pass
+
+class wtLightServer():
+    """ Stand-in for wtServer, the first call is slow so a second one would pass it """
+
+    def __init__(self,fail=()):
+        self.calls = list()
+        self.fail  = fail
+
+    def call(self,name,lit):
+        if len(self.calls) == 0:
+            time.sleep(0.2)
+        self.calls.append(name)
+        if name in self.fail:
+            return { 'st': False }
+        return { 'st': True, 'result': { 'lit': lit } }
+
+    def LightOn(self,mgr_mac,id,flash):
+        return self.call('on',2 if flash else 1)
+
+    def LightOff(self,mgr_mac,id):
+        return self.call('off',0)
+
+def make_tag(server):
+    controller = wtStub()
+    controller.tasks = wtTaskExecutor(logger,workers=4)
+    controller.command_stats = dict()
+    controller.l_info  = lambda name, string: None
+    controller.l_error = lambda name, string: None
+    controller.submit_command = partial(wtController.submit_command,controller)
+    controller.command_done   = partial(wtController.command_done,controller)
+    tag = wTag.__new__(wTag)
+    tag.controller = controller
+    tag.address = 'tag1'
+    tag.tag_id = 1
+    tag.primary_n = wtStub()
+    tag.primary_n.mac = 'MAC1'
+    tag.primary_n.wtServer = server
+    tag.lit = None
+    tag.light_seq = 0
+    tag.history = list()
+    def set_lit(value):
+        tag.lit = int(value)
+        tag.history.append(tag.lit)
+    tag.set_lit = set_lit
+    tag.set_from_tag_data = lambda data: set_lit(data['lit'])
+    return tag
+
+def wait_idle(tasks):
+    for i in range(200):
+        with tasks.lock:
+            if len(tasks.serials) == 0 and tasks.pending() == 0:
+                return True
+        time.sleep(0.01)
+    return False
+
+class TestCommands(unittest.TestCase):
+
+    def test_on_off(self):
+        server = wtLightServer()
+        tag = make_tag(server)
+        tag.cmd_set_light({'value': 1})
+        tag.cmd_set_light({'value': 0})
+        self.assertEqual(tag.lit,0)
+        self.assertTrue(wait_idle(tag.controller.tasks))
+        # OFF waited for the slow ON, and ON's result didn't undo it.
+        self.assertEqual(server.calls,['on','off'])
+        self.assertEqual(tag.history,[1,0,0])
+        self.assertEqual(tag.controller.command_stats['set_light']['count'],2)
+
+    def test_rollback(self):
+        server = wtLightServer(fail=('off',))
+        tag = make_tag(server)
+        tag.lit = 1
+        tag.cmd_set_light({'value': 0})
+        self.assertTrue(wait_idle(tag.controller.tasks))
+        self.assertEqual(tag.lit,1)
+        self.assertEqual(tag.controller.command_stats['set_light']['failed'],1)
+
+    def test_rollback_newer(self):
+        # ON failed, but OFF came after it, so the status stays off.
+        server = wtLightServer(fail=('on',))
+        tag = make_tag(server)
+        tag.lit = 0
+        tag.cmd_set_light({'value': 1})
+        tag.cmd_set_light({'value': 0})
+        self.assertTrue(wait_idle(tag.controller.tasks))
+        self.assertEqual(server.calls,['on','off'])
+        self.assertEqual(tag.lit,0)
+
+    def test_serial(self):
+        tasks = wtTaskExecutor(logger,workers=4)
+        order = list()
+        def job(name,delay):
+            time.sleep(delay)
+            order.append(name)
+        tasks.submit('a',job,args=('a1',0.2),serial='a')
+        tasks.submit('a',job,args=('a2',0),serial='a')
+        tasks.submit('b',job,args=('b1',0),serial='b')
+        self.assertTrue(wait_idle(tasks))
+        time.sleep(0.05)
+        # b doesn't wait for a, a2 does.
+        self.assertEqual(order,['b1','a1','a2'])
+
+if __name__ == '__main__':
+    unittest.main()
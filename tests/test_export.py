@@ -0,0 +1,75 @@
+"""
+wtExporter against stand-in UDP and HTTP receivers on localhost.
+"""
+import os,sys,time,socket,threading,logging,unittest
+from http.server import HTTPServer,BaseHTTPRequestHandler
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wt_export import wtExporter,make_line
+
+logger = logging.getLogger('test_export')
+
+class wtReceiver(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.path,data.decode('utf-8')))
+        self.server.got.set()
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class TestExport(unittest.TestCase):
+
+    def test_make_line(self):
+        line = make_line('wirelesstag',{'name': 'Front Door', 'tag_type': ''},{'CLITEMP': 21, 'ST': 'on'},1.5)
+        self.assertEqual(line,'wirelesstag,name=Front\\ Door CLITEMP=21.0,ST="on" 1500000000')
+
+    def test_udp(self):
+        sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1',0))
+        sock.settimeout(5)
+        self.addCleanup(sock.close)
+        exporter = wtExporter(logger,'udp://127.0.0.1:{0}'.format(sock.getsockname()[1]),batch_size=2,flush_interval=60)
+        exporter.start()
+        exporter.add({'address': 'tag1'},{'CLITEMP': 20.5},10)
+        exporter.add({'address': 'tag1'},{'CLIHUM': 40},10)
+        lines = sock.recv(65536).decode('utf-8').splitlines()
+        self.assertEqual(lines,[
+            'wirelesstag,address=tag1 CLITEMP=20.5 10000000000',
+            'wirelesstag,address=tag1 CLIHUM=40.0 10000000000'])
+        # The stats are counted after the sendto returns.
+        for i in range(50):
+            if exporter.stats['sent'] == 2: break
+            time.sleep(0.01)
+        self.assertEqual(exporter.stats['sent'],2)
+
+    def test_http(self):
+        server = HTTPServer(('127.0.0.1',0),wtReceiver)
+        server.received = list()
+        server.got = threading.Event()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        exporter = wtExporter(logger,'http://127.0.0.1:{0}/write?db=wirelesstags'.format(server.server_port),flush_interval=60)
+        exporter.start()
+        exporter.add({'address': 'tag2'},{'LUMIN': 300},10)
+        exporter.flush()
+        self.assertTrue(server.got.wait(5))
+        self.assertEqual(server.received,[('/write?db=wirelesstags','wirelesstag,address=tag2 LUMIN=300.0 10000000000\n')])
+
+    def test_http_failed(self):
+        # Nothing listening, the points are counted as failed and not retried.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1',0))
+        port = sock.getsockname()[1]
+        sock.close()
+        exporter = wtExporter(logger,'http://127.0.0.1:{0}/write'.format(port),timeout=2)
+        self.assertFalse(exporter.send(['wirelesstag,address=tag3 ST=1.0']))
+        self.assertEqual(exporter.stats['failed'],1)
+
+if __name__ == '__main__':
+    unittest.main()
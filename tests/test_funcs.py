@@ -0,0 +1,41 @@
+"""
+iter_json_list with the data split into chunks at every place it can be.
+"""
+import os,sys,json,unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wt_funcs import iter_json_list
+
+DATA = ('{"__type":"x","info":{"d":[9,9]},"name":"a \\"d\\":[ [{",'
+        '"d":[ 1234, -5.5e3, {"name":"tag [1] {x}","slaveId":3,"temp":21.25}, "s]", true, null, [1,2] ],"more":1}')
+
+def split(data,size):
+    return [data[i:i+size] for i in range(0,len(data),size)]
+
+class TestIterJsonList(unittest.TestCase):
+
+    def test_whole(self):
+        self.assertEqual(list(iter_json_list([DATA])),json.loads(DATA)['d'])
+
+    def test_every_split(self):
+        want = json.loads(DATA)['d']
+        for i in range(1,len(DATA)):
+            self.assertEqual(list(iter_json_list([DATA[:i],DATA[i:]])),want,'split at {0}'.format(i))
+
+    def test_small_chunks(self):
+        want = json.loads(DATA)['d']
+        for size in (1,2,3,7):
+            self.assertEqual(list(iter_json_list(split(DATA,size))),want,'chunks of {0}'.format(size))
+
+    def test_number_split(self):
+        self.assertEqual(list(iter_json_list(['{"d":[12','34]}'])),[1234])
+
+    def test_no_list(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_list(['{"x":{"d":[1]}}']))
+
+    def test_incomplete(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_list(['{"d":[1,2']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+wtPublisher priority classes, coalescing and the low priority rate limit.
+"""
+import os,sys,time,threading,logging,unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wt_publish import wtPublisher
+
+logger = logging.getLogger('test_publish')
+
+def sent_drivers(sent):
+    return [(m['status']['address'],m['status']['driver'],m['status']['value']) for m in sent]
+
+def wait_sent(sent,count,timeout=5):
+    etime = time.time() + timeout
+    while len(sent) < count and time.time() < etime:
+        time.sleep(0.01)
+    return len(sent) >= count
+
+class TestPublish(unittest.TestCase):
+
+    def test_priority(self):
+        sent = list()
+        publisher = wtPublisher(logger,sent.append)
+        publisher.publish('t1','BATLVL',90,51)
+        publisher.publish('t1','CLITEMP',20,17)
+        publisher.publish('t1','GV2',1,25)
+        publisher.start()
+        self.assertTrue(wait_sent(sent,3))
+        self.assertEqual(sent_drivers(sent),[('t1','GV2','1'),('t1','CLITEMP','20'),('t1','BATLVL','90')])
+
+    def test_alarm_fifo(self):
+        # Every alarm change is sent, in order.
+        sent = list()
+        publisher = wtPublisher(logger,sent.append)
+        for value in (1,0,1):
+            publisher.publish('t1','GV2',value,25)
+        self.assertEqual(publisher.pending()['alarm'],3)
+        publisher.start()
+        self.assertTrue(wait_sent(sent,3))
+        self.assertEqual(sent_drivers(sent),[('t1','GV2','1'),('t1','GV2','0'),('t1','GV2','1')])
+
+    def test_alarm_unchanged(self):
+        # A refresh of an alarm that didn't change coalesces as normal.
+        sent = list()
+        publisher = wtPublisher(logger,sent.append)
+        publisher.publish('t1','GV2',1,25,changed=False)
+        publisher.publish('t1','GV2',1,25,changed=False)
+        self.assertEqual(publisher.pending(),{ 'alarm': 0, 'normal': 1, 'low': 0 })
+        # A real change drops the older refresh.
+        publisher.publish('t1','GV2',0,25)
+        self.assertEqual(publisher.pending(),{ 'alarm': 1, 'normal': 0, 'low': 0 })
+        publisher.start()
+        self.assertTrue(wait_sent(sent,1))
+        time.sleep(0.05)
+        self.assertEqual(sent_drivers(sent),[('t1','GV2','0')])
+
+    def test_coalesce(self):
+        sent = list()
+        publisher = wtPublisher(logger,sent.append)
+        publisher.publish('t1','CLITEMP',20,17)
+        publisher.publish('t2','CLITEMP',30,17)
+        publisher.publish('t1','CLITEMP',21,17)
+        publisher.start()
+        self.assertTrue(wait_sent(sent,2))
+        time.sleep(0.05)
+        # t1 keeps it's place, with the new value.
+        self.assertEqual(sent_drivers(sent),[('t1','CLITEMP','21'),('t2','CLITEMP','30')])
+        self.assertEqual(publisher.get_stats()['normal']['coalesced'],1)
+
+    def test_low_rate(self):
+        sent = list()
+        publisher = wtPublisher(logger,sent.append,low_rate=10)
+        for i in range(20):
+            publisher.publish('t{0}'.format(i),'BATLVL',90,51)
+        stime = time.time()
+        publisher.start()
+        self.assertTrue(wait_sent(sent,20))
+        # 10 right away from the full bucket, then 10 a second.
+        self.assertGreaterEqual(time.time() - stime,0.8)
+
+    def test_low_rate_under_one(self):
+        sent = list()
+        publisher = wtPublisher(logger,sent.append,low_rate=0.5)
+        publisher.publish('t1','BATLVL',90,51)
+        publisher.start()
+        self.assertTrue(wait_sent(sent,1,timeout=1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+wtServer.http_request on a LAN route with stand-in Tag Manager and cloud servers.
+"""
+import os,sys,socket,threading,logging,unittest
+from http.server import HTTPServer,BaseHTTPRequestHandler
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wtServer import wtServer,wtRoute
+
+logger = logging.getLogger('test_routes')
+
+class wtStandIn(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.path,self.headers.get('Authorization')))
+        if self.server.drop:
+            # Got it, but the answer never gets back.
+            self.close_connection = True
+            return
+        body = b'{"d": true}'
+        self.send_response(200)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(drop=False):
+    server = HTTPServer(('127.0.0.1',0),wtStandIn)
+    server.received = list()
+    server.drop = drop
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1',0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class TestRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.cloud = self.add_server()
+        self.server = wtServer(logger,'client','secret')
+        self.server.cloud = wtRoute('cloud','http://127.0.0.1:{0}/'.format(self.cloud.server_port))
+        self.server.access_token = 'secret-token'
+        self.server.token_type = 'Bearer'
+        self.server.last_selected = 'MAC1'
+
+    def add_server(self,drop=False):
+        server = start_server(drop)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_lan(self):
+        lan = self.add_server()
+        self.server.set_lan_url('MAC1','http://127.0.0.1:{0}/'.format(lan.server_port))
+        response = self.server.http_request('ethClient.asmx/LoadTagList','{}')
+        self.assertEqual(response.json(),{'d': True})
+        # The cloud token stays off the LAN.
+        self.assertEqual(lan.received,[('/ethClient.asmx/LoadTagList',None)])
+        self.assertEqual(self.cloud.received,[])
+
+    def test_lan_refused(self):
+        self.server.set_lan_url('MAC1','http://127.0.0.1:{0}/'.format(closed_port()))
+        response = self.server.http_request('ethClient.asmx/LoadTagList','{}')
+        self.assertEqual(response.json(),{'d': True})
+        # It was only selected on the LAN, so the cloud selects it first.
+        self.assertEqual(self.cloud.received,[
+            ('/ethAccount.asmx/SelectTagManager','Bearer secret-token'),
+            ('/ethClient.asmx/LoadTagList','Bearer secret-token')])
+        self.assertFalse(self.server.lan_routes['MAC1'].available())
+
+    def test_lan_no_response(self):
+        # The Tag Manager may have done it, so it isn't sent again through the cloud.
+        lan = self.add_server(drop=True)
+        self.server.set_lan_url('MAC1','http://127.0.0.1:{0}/'.format(lan.server_port))
+        self.assertFalse(self.server.http_request('ethClient.asmx/Beep','{}'))
+        self.assertEqual(lan.received,[('/ethClient.asmx/Beep',None)])
+        self.assertEqual(self.cloud.received,[])
+        self.assertIsNone(self.server.last_selected)
+
+    def test_cloud_down(self):
+        lan = self.add_server()
+        self.server.cloud = wtRoute('cloud','http://127.0.0.1:{0}/'.format(closed_port()))
+        self.server.last_selected = None
+        self.server.set_lan_url('MAC1','http://127.0.0.1:{0}/'.format(lan.server_port))
+        with self.server.select_lock:
+            self.assertTrue(self.server.SelectTagManager('MAC1')['st'])
+            self.assertEqual(self.server.GetTagList('MAC1'),{'st': True, 'result': True})
+        self.assertEqual(lan.received,[('/ethClient.asmx/GetTagList',None)])
+
+    def test_lan_mac(self):
+        # The mac picks the route, not whichever was selected last.
+        lan = self.add_server()
+        self.server.set_lan_url('MAC1','http://127.0.0.1:{0}/'.format(lan.server_port))
+        self.server.last_selected = 'MAC2'
+        self.assertTrue(self.server.LightOff('MAC1',3)['st'])
+        self.assertEqual(lan.received,[('/ethClient.asmx/LightOff',None)])
+        self.assertEqual(self.cloud.received,[])
+
+    def test_cloud_only(self):
+        self.server.set_lan_url('MAC1','http://127.0.0.1:{0}/'.format(closed_port()))
+        self.server.http_request('api/Login','{}',use_token=False)
+        self.assertEqual(self.cloud.received,[('/api/Login',None)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+wtTaskExecutor priority, keys and cancel.
+"""
+import os,sys,time,threading,logging,unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wt_tasks import wtTaskExecutor,PRIORITY_HIGH,PRIORITY_LOW
+
+logger = logging.getLogger('test_tasks')
+
+def blocked(tasks):
+    """ Hold the only worker until the event is set """
+    release = threading.Event()
+    started = threading.Event()
+    def hold():
+        started.set()
+        release.wait(5)
+    tasks.submit('hold',hold)
+    started.wait(5)
+    return release
+
+class TestTasks(unittest.TestCase):
+
+    def test_priority(self):
+        tasks = wtTaskExecutor(logger,workers=1)
+        release = blocked(tasks)
+        order = list()
+        tasks.submit('low',order.append,args=('low',),priority=PRIORITY_LOW)
+        tasks.submit('normal',order.append,args=('normal',))
+        last = tasks.submit('high',order.append,args=('high',),priority=PRIORITY_HIGH)
+        tasks.submit('normal2',order.append,args=('normal2',))
+        release.set()
+        for i in range(100):
+            if len(order) == 4: break
+            time.sleep(0.01)
+        self.assertEqual(order,['high','normal','normal2','low'])
+        self.assertTrue(last.done.is_set())
+
+    def test_key(self):
+        tasks = wtTaskExecutor(logger,workers=1)
+        release = blocked(tasks)
+        first  = tasks.submit('discover',lambda: 1,key='discover')
+        second = tasks.submit('discover',lambda: 2,key='discover')
+        self.assertIs(first,second)
+        self.assertTrue(tasks.running('discover'))
+        release.set()
+        self.assertTrue(first.wait(5))
+        self.assertEqual(first.result,1)
+        for i in range(100):
+            if not tasks.running('discover'): break
+            time.sleep(0.01)
+        self.assertFalse(tasks.running('discover'))
+        # Done, so the key can be used again.
+        self.assertIsNot(tasks.submit('discover',lambda: 3,key='discover'),first)
+
+    def test_cancel(self):
+        tasks = wtTaskExecutor(logger,workers=1)
+        release = blocked(tasks)
+        ran  = list()
+        done = list()
+        task = tasks.submit('ping',ran.append,args=(1,),key='ping',callback=done.append)
+        self.assertTrue(tasks.cancel('ping'))
+        self.assertFalse(tasks.cancel('ping'))
+        release.set()
+        self.assertTrue(task.wait(5))
+        self.assertEqual(ran,[])
+        self.assertTrue(task.cancelled)
+        self.assertEqual(done,[task])
+
+    def test_cancel_started(self):
+        tasks = wtTaskExecutor(logger,workers=1)
+        release = threading.Event()
+        task = tasks.submit('hold',release.wait,args=(5,),key='hold')
+        for i in range(100):
+            if task.started: break
+            time.sleep(0.01)
+        self.assertFalse(tasks.cancel('hold'))
+        release.set()
+        self.assertTrue(task.wait(5))
+        self.assertFalse(task.cancelled)
+
+    def test_error(self):
+        tasks = wtTaskExecutor(logger,workers=1)
+        done = list()
+        task = tasks.submit('fail',lambda: 1 / 0,callback=done.append)
+        self.assertTrue(task.wait(5))
+        for i in range(100):
+            if len(done) == 1: break
+            time.sleep(0.01)
+        self.assertIsInstance(task.error,ZeroDivisionError)
+        self.assertEqual(done,[task])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,14 +5,48 @@
 """
 
 from http.server import HTTPServer,BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 from urllib import parse
 from urllib.parse import parse_qsl
-import socket, threading, sys, requests, json
+import socket, threading, sys, os, time, requests, json, codecs, logging, logging.handlers, multiprocessing
 import netifaces as ni
+from urllib3.exceptions import NewConnectionError,ConnectTimeoutError
+from copy import deepcopy
+from queue import Empty
+from wt_params import wt_params,wt_types
+from wt_funcs import iter_json_list
+from wt_routes import make_routes,make_response
+
+# Start the REST worker fresh instead of forking, a fork copies the locks
+# held by our other threads, like logging's, and can deadlock on them.
+mp = multiprocessing.get_context('spawn')
 
 class wtHandler(BaseHTTPRequestHandler):
+    # Keep connections open so the cloud doesn't connect for every event,
+    # every response must have a Content-Length for this to work.
+    protocol_version = 'HTTP/1.1'
+    # Seconds an idle connection is kept
+    timeout = 30
+    routes = make_routes(protocol_version)
+    # For wtRESTWatchdog, only says the listener is answering.
+    health = make_response('/health',200,protocol_version)
 
     def do_GET(self):
+        rtime = time.time()
+        path, sep, query = self.path.partition('?')
+        if path == '/health':
+            self.wfile.write(self.health)
+            return
+        route = self.routes.get(path)
+        if route is not None and not 'debug' in query:
+            # Events take the fast path, decoded by the route and the response is ready to go.
+            decode, responses = route
+            params = decode(query)
+            # When we got it, for wtLatency
+            params['_rtime'] = rtime
+            st = self.parent.event_handler(path,params)
+            self.wfile.write(responses[bool(st)])
+            return
         parsed_path = parse.urlparse(self.path)
         self.query = dict(parse_qsl(parsed_path.query))
         if 'debug' in self.query:
@@ -42,48 +76,171 @@ class wtHandler(BaseHTTPRequestHandler):
         else:
             message_parts = ["Received: {0} {1}. ".format(parsed_path.path,self.query)]
         # We send back a response quickly cause the TAG Manager doesn't wait very long?
+        self.query['_rtime'] = rtime
         hrt = self.parent.get_handler(parsed_path.path,self.query)
         message_parts.append("Code: {0}".format(int(hrt['code'])))
         message_parts.append(hrt['message'])
         self.send_response(int(hrt['code']))
         self.send_header('Content-Type',
                          'text/plain; charset=utf-8')
-        self.end_headers()
         message_parts.append('')
         message = '\r\n'.join(message_parts)
         message += '\r\n'
-        self.wfile.write(message.encode('utf-8'))
+        message = message.encode('utf-8')
+        self.send_header('Content-Length',len(message))
+        self.end_headers()
+        self.wfile.write(message)
+
+    def do_POST(self):
+        """
+        JSON events, see wt_json_template.  The body is one event or a list
+        of them if the cloud batches them up.
+        """
+        rtime  = time.time()
+        try:
+            length = int(self.headers.get('Content-Length',0))
+            if length < 0: raise ValueError(length)
+        except ValueError:
+            hrt = { 'code': 400, 'message': 'Bad Content-Length: {0}'.format(self.headers.get('Content-Length')) }
+            # Don't know where the body ends, so the connection can't be reused.
+            self.close_connection = True
+        else:
+            try:
+                data = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError as err:
+                hrt = { 'code': 400, 'message': 'Bad JSON: {0}'.format(err) }
+            else:
+                # post_handler rejects anything that isn't an event.
+                if not isinstance(data,list):
+                    data = [data]
+                hrt = self.parent.post_handler(data,rtime)
+        message = '{0}\r\nCode: {1}\r\n'.format(hrt['message'],int(hrt['code'])).encode('utf-8')
+        self.send_response(int(hrt['code']))
+        self.send_header('Content-Type',
+                         'text/plain; charset=utf-8')
+        self.send_header('Content-Length',len(message))
+        self.end_headers()
+        self.wfile.write(message)
 
     def log_message(self, fmt, *args):
         # Stop log messages going to stdout
         self.parent.logger.info('wtHandler:log_message' + fmt % args)
 
+class wtHTTPServer(ThreadingMixIn,HTTPServer):
+    # So we can rebind our old port while the previous one is in TIME_WAIT
+    allow_reuse_address = True
+    daemon_threads = True
+    # Each open connection has a thread, more than this are closed right away,
+    # after a 503 so wtRESTWatchdog knows we are busy and not stuck.
+    max_connections = 16
+    busy = b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+    def __init__(self,*args,connections=None,**kwargs):
+        # A restart passes the old one's, it's connections are still open.
+        if connections is None:
+            connections = threading.BoundedSemaphore(self.max_connections)
+        self.connections = connections
+        super().__init__(*args,**kwargs)
+
+    def process_request(self,request,client_address):
+        if not self.connections.acquire(blocking=False):
+            try:
+                request.settimeout(0)
+                request.send(self.busy)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request,client_address)
+        except Exception:
+            self.connections.release()
+            raise
+
+    def process_request_thread(self,request,client_address):
+        try:
+            super().process_request_thread(request,client_address)
+        finally:
+            self.connections.release()
+
 class wtREST():
 
     def __init__(self,parent,logger):
         self.parent  = parent
         self.logger  = logger
+        # Connections have their own threads now, but events should still be
+        # handled one at a time, in the order they came in.
+        self.lock    = threading.Lock()
+        self.thread  = None
 
-    def start(self):
-        port    = 0
+    def start(self,port=0):
+        """
+        Start on port, if it can't be bound then let the kernel give us
+        one and set port_changed so the caller knows the tag URL's are wrong.
+        """
         self.myip    = self.get_network_ip_rhost('8.8.8.8')
         if self.myip is False:
             self.logger.error("wtREST: Can not start on IP={0}".format(self.myip))
             return False
         self.logger.info("wtREST: Running on IP={0}".format(self.myip))
-        self.address = (self.myip, port) # let the kernel give us a port
-        self.logger.debug("wtREST: address={0}".format(self.address))
+        if not self.bind(port):
+            return False
+        self.serve()
+        return True
+
+    def serve(self):
+        self.thread  = threading.Thread(target=self.server.serve_forever,name='wtREST')
+        # Need this so the thread will die when the main process dies
+        self.thread.daemon = True
+        self.thread.start()
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def restart(self):
+        """
+        Close the listener and bind a new one on the same port, the tag
+        URLs have it so it can't change.
+        """
+        # shutdown() waits for serve_forever, which may be stuck, so not here.
+        old = self.server
+        threading.Thread(target=old.shutdown,daemon=True).start()
+        try:
+            old.server_close()
+        except OSError:
+            pass
+        self.address = (self.myip, self.listen_port)
+        for i in range(10):
+            try:
+                self.server = wtHTTPServer(self.address, wtHandler, connections=old.connections)
+            except OSError as err:
+                self.logger.error('wtREST:restart: failed to bind {0}: {1}'.format(self.address,err))
+                time.sleep(0.1)
+                continue
+            self.serve()
+            return True
+        return False
+
+    def bind(self,port,new_port=True):
         # Get a handler and set parent to myself, so we can process the requests.
         eh = wtHandler
         eh.parent = self
-        self.server = HTTPServer(self.address, wtHandler)
+        self.port_changed = False
+        self.address = (self.myip, int(port))
+        self.logger.debug("wtREST: address={0}".format(self.address))
+        try:
+            self.server = wtHTTPServer(self.address, wtHandler)
+        except OSError as err:
+            if int(port) == 0 or not new_port:
+                self.logger.error('wtREST: failed to bind {0}: {1}'.format(self.address,err), exc_info=True)
+                return False
+            self.logger.error('wtREST: failed to bind {0}, getting a new port: {1}'.format(self.address,err))
+            self.address = (self.myip, 0) # let the kernel give us a port
+            self.server = wtHTTPServer(self.address, wtHandler)
+            self.port_changed = True
         self.url     = 'http://{0}:{1}'.format(self.server.server_address[0],self.server.server_address[1])
         self.listen_port = self.server.server_address[1]
         self.logger.info("wtREST: Running on: {0}".format(self.url))
-        self.thread  = threading.Thread(target=self.server.serve_forever)
-        # Need this so the thread will die when the main process dies
-        self.thread.daemon = True
-        self.thread.start()
         return True
         #try:
         #    self.server.serve_forever()
@@ -98,7 +255,44 @@ class wtREST():
         #self.server.server_close()
 
     def get_handler(self,path,query):
-        return self.parent.get_handler(path,query)
+        if path == '/code':
+            # Getting the token can take a while, and isn't a tag event.
+            return self.parent.get_handler(path,query)
+        with self.lock:
+            return self.parent.get_handler(path,query)
+
+    def event_handler(self,path,params):
+        with self.lock:
+            return self.parent.event_handler(path,params)
+
+    def post_handler(self,events,rtime=None):
+        """
+        Convert each JSON event to typed params and pass it on like a get.
+        """
+        code     = 200
+        messages = list()
+        for event in events:
+            if not isinstance(event,dict) or not 'event' in event:
+                code = 400
+                messages.append('No event in {0}'.format(event))
+                continue
+            params = dict()
+            for key, value in event.items():
+                if key == 'event': continue
+                if key in wt_types:
+                    try:
+                        value = wt_types[key](value)
+                    except (TypeError, ValueError):
+                        # Cloud leaves fields empty when the tag doesn't have them.
+                        continue
+                params[key] = value
+            if rtime is not None:
+                params['_rtime'] = rtime
+            hrt = self.get_handler('/' + event['event'],params)
+            if int(hrt['code']) != 200:
+                code = hrt['code']
+            messages.append(hrt['message'])
+        return { 'code': code, 'message': '\r\n'.join(messages) }
 
     def get_network_ip_rhost(self,rhost):
         self.logger.info("wtREST:get_network_ip: {0}".format(rhost))
@@ -126,10 +320,334 @@ class wtREST():
         self.logger.info("wtREST:get_network_ip: Failed")
         return False
 
+class wtRESTProcess(wtREST):
+    """
+    Runs the listener in it's own process so it's not waiting on the GIL
+    when the node server is busy.  The worker acks and queues the events,
+    a thread here passes them on to the parent.
+    """
+
+    def start(self,port=0):
+        self.myip    = self.get_network_ip_rhost('8.8.8.8')
+        if self.myip is False:
+            self.logger.error("wtRESTProcess: Can not start on IP={0}".format(self.myip))
+            return False
+        # The worker's log records come back here to our logger.
+        self.log_queue = mp.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_queue,wtLogForward(self.logger))
+        self.log_listener.start()
+        st = self.spawn(port)
+        if st is False:
+            return False
+        self.listen_port  = st['port']
+        self.port_changed = st['port_changed']
+        self.url          = 'http://{0}:{1}'.format(self.myip,self.listen_port)
+        self.logger.info("wtRESTProcess: Running on: {0} pid={1}".format(self.url,self.process.pid))
+        self.thread  = threading.Thread(target=self.dispatch,name='wtRESTDispatch')
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def spawn(self,port,new_port=True):
+        """ Start the worker, with a new queue for it's events, returns what it bound to or False """
+        queue = mp.Queue()
+        rconn, wconn = mp.Pipe(duplex=False)
+        self.process = mp.Process(target=rest_worker,name='wtREST',
+                                  args=(self.myip,port,queue,wconn,self.log_queue,self.logger.getEffectiveLevel(),new_port))
+        self.process.daemon = True
+        self.process.start()
+        wconn.close()
+        # Wait for the worker to tell us what it bound to.
+        if not rconn.poll(30):
+            self.logger.error("wtRESTProcess: No response from worker")
+            self.process.terminate()
+            return False
+        st = rconn.recv()
+        rconn.close()
+        if st['st'] is False:
+            self.logger.error("wtRESTProcess: worker failed to start")
+            return False
+        self.queue = queue
+        return st
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def restart(self):
+        """
+        A new worker on the same port.  Terminating the old one can leave
+        it's queue broken, so dispatch moves to the new one's.
+        """
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(5)
+        if self.spawn(self.listen_port,False) is False:
+            return False
+        self.logger.info("wtRESTProcess: Restarted on: {0} pid={1}".format(self.url,self.process.pid))
+        return True
+
+    def dispatch(self):
+        queue = self.queue
+        while True:
+            if queue is not self.queue:
+                self.logger.info('wtRESTProcess:dispatch: using the new worker queue')
+                queue = self.queue
+            try:
+                path, params = queue.get(timeout=1)
+            except Empty:
+                continue
+            if path == '/code':
+                # Don't hold up the events while we get the token.
+                threading.Thread(target=self.parent.get_handler,args=(path,params),daemon=True).start()
+                continue
+            try:
+                # Only this thread sends events, but wTag.end_burst takes the lock too.
+                with self.lock:
+                    self.parent.get_handler(path,params)
+            except Exception as err:
+                self.logger.error('wtRESTProcess:dispatch: {0} {1} failed: {2}'.format(path,params,err), exc_info=True)
+
+class wtRESTWorker(wtREST):
+    """
+    The wtREST in the worker process, only checks the events are something
+    we can use and puts them on the queue.
+    """
+
+    def __init__(self,queue,logger):
+        self.queue  = queue
+        self.logger = logger
+
+    def get_handler(self,path,query):
+        if path == '/favicon.ico':
+            return { 'code': 200, 'message': 'Ignored {0}'.format(path) }
+        if path == '/code':
+            if not 'code' in query:
+                return { 'code': 400, 'message': 'No code in {0}'.format(query) }
+            message = "Got code {}, asking for access token, see the node server log for the result".format(query['code'])
+        else:
+            if not path[1:] in wt_params:
+                return { 'code': 404, 'message': 'Unknown command {0}'.format(path) }
+            if not 'tagid' in query or not 'tmgr_mac' in query:
+                return { 'code': 400, 'message': 'Command {0} missing tagid or tmgr_mac'.format(path) }
+            message = 'Command {0} queued'.format(path)
+        self.queue.put((path,query))
+        return { 'code': 200, 'message': message }
+
+    def event_handler(self,path,params):
+        if not 'tagid' in params or not 'tmgr_mac' in params:
+            self.logger.error('wtRESTWorker: Command {0} missing tagid or tmgr_mac: {1}'.format(path,params))
+            return False
+        self.queue.put((path,params))
+        return True
+
+class wtLogForward(logging.Handler):
+    """ Passes the records from the REST worker to our logger """
+
+    def __init__(self,logger):
+        super().__init__()
+        self.logger = logger
+
+    def emit(self,record):
+        self.logger.handle(record)
+
+def rest_worker(myip,port,queue,conn,log_queue,log_level,new_port=True):
+    # Nothing is set up in a spawned process, send our records to the parent.
+    logger = logging.getLogger('wtREST')
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(log_level)
+    logger.propagate = False
+    rest = wtRESTWorker(queue,logger)
+    rest.myip = myip
+    try:
+        st = rest.bind(port,new_port)
+    except Exception as err:
+        logger.error('rest_worker: bind failed: {0}'.format(err), exc_info=True)
+        st = False
+    if st:
+        conn.send({ 'st': True, 'port': rest.listen_port, 'port_changed': rest.port_changed })
+    else:
+        conn.send({ 'st': False })
+    conn.close()
+    if not st:
+        return
+    # Exit when our parent does, even if it didn't get to clean up.
+    ppid = os.getppid()
+    def watch_parent():
+        while os.getppid() == ppid:
+            time.sleep(5)
+        os._exit(0)
+    threading.Thread(target=watch_parent,daemon=True).start()
+    rest.server.serve_forever()
+
+class wtRESTWatchdog():
+    """
+    Asks the REST listener for /health every interval seconds and restarts
+    it on the same port when the thread or process is gone, or it misses
+    failures checks in a row.
+    """
+
+    def __init__(self,rest,logger,interval=0.5,timeout=0.5,failures=2):
+        self.rest       = rest
+        self.logger     = logger
+        self.interval   = interval
+        self.timeout    = timeout
+        self.failures   = failures
+        self.missed     = 0
+        self.down_since = None
+        self.stats      = { 'checks': 0, 'missed': 0, 'restarts': 0, 'restart_failed': 0, 'downtime': 0.0, 'last_restart': None }
+        self.thread     = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._watch,name='wtRESTWatchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check(self):
+        """ True if the listener answered /health """
+        try:
+            with socket.create_connection((self.rest.myip,self.rest.listen_port),self.timeout) as sock:
+                sock.sendall(b'GET /health HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+                # 503 is all the connections in use, it's still answering.
+                return sock.recv(64).split(b' ',2)[1:2] in ([b'200'], [b'503'])
+        except OSError:
+            return False
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            self.stats['checks'] += 1
+            alive = self.rest.alive()
+            if alive and self.check():
+                if self.down_since is not None:
+                    self.stats['downtime'] += time.time() - self.down_since
+                    self.down_since = None
+                self.missed = 0
+                continue
+            self.stats['missed'] += 1
+            self.missed += 1
+            if self.down_since is None:
+                self.down_since = time.time()
+            if alive and self.missed < self.failures:
+                continue
+            self.l_error('_watch','Listener {0} alive={1} missed={2}, restarting'.format(self.rest.url,alive,self.missed))
+            try:
+                st = self.rest.restart()
+            except Exception as err:
+                self.l_error('_watch','restart failed: {0}'.format(err))
+                st = False
+            if st:
+                self.stats['restarts'] += 1
+                self.stats['last_restart'] = time.ctime()
+                self.missed = 0
+            else:
+                self.stats['restart_failed'] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        if self.down_since is not None:
+            stats['downtime'] += time.time() - self.down_since
+        stats['downtime'] = round(stats['downtime'],1)
+        return stats
+
+    def l_error(self, name, string):
+        self.logger.error("wtRESTWatchdog:%s: %s" % (name,string))
+
+def not_sent(err):
+    """ True if the requests exception err means the request never got to the server """
+    if isinstance(err,requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(err,requests.exceptions.ConnectionError) and len(err.args) > 0:
+        reason = getattr(err.args[0],'reason',err.args[0])
+        return isinstance(reason,(NewConnectionError,ConnectTimeoutError))
+    return False
+
+class wtRoute():
+    """
+    A base url the API can be called on, the cloud or a Tag Manager on the
+    LAN, with the latency of each path sent through it.  A LAN route that
+    fails is skipped for retry seconds.
+    """
+
+    def __init__(self,name,base_url,retry=300):
+        if not base_url.endswith('/'):
+            base_url += '/'
+        self.name       = name
+        self.base_url   = base_url
+        self.retry      = retry
+        self.down_until = 0
+        self.lock       = threading.Lock()
+        self.stats      = dict()
+
+    def available(self):
+        return time.time() >= self.down_until
+
+    def set_down(self):
+        self.down_until = time.time() + self.retry
+
+    def record(self,path,elapsed,ok):
+        with self.lock:
+            st = self.stats.get(path)
+            if st is None:
+                st = self.stats[path] = { 'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0 }
+            st['count'] += 1
+            if not ok:
+                st['errors'] += 1
+            st['total'] += elapsed
+            st['max'] = max(st['max'],elapsed)
+
+    def get_stats(self):
+        """ { path: { count, errors, avg_ms, max_ms } } """
+        with self.lock:
+            return dict((path, {
+                'count':  st['count'],
+                'errors': st['errors'],
+                'avg_ms': round(st['total'] * 1000 / st['count'],1),
+                'max_ms': round(st['max'] * 1000,1),
+            }) for path, st in self.stats.items())
+
 class wtServer():
 
-    def __init__(self,logger,client_id,client_secret,ghandler=None,oauth2_code=False):
+    def __init__(self,logger,client_id,client_secret,ghandler=None,oauth2_code=False,port=0,rest_process=False,token=None,token_handler=None,cache_ttl=5,
+                 account='default',rest=None,watchdog=0.5):
         self.logger = logger
+        self.port   = port
+        self.rest_process = rest_process
+        # The account name, used as the oauth2 state, and the REST server
+        # if we share another account's.
+        self.account = account
+        self.rest    = rest
+        # Seconds between listener health checks, 0 for none.
+        self.watchdog_interval = watchdog
+        self.watchdog = None
+        # The other accounts using our REST server, by name.
+        self.peers   = dict()
+        # Each account gets it's own connections.
+        self.session = requests.Session()
+        # Tag Managers we can reach on the LAN by mac, ethClient calls for
+        # them go there first.
+        self.cloud   = wtRoute('cloud','http://wirelesstag.net/')
+        self.lan_routes = dict()
+        # The last token we got, and who to tell when we get a new one.
+        self.token  = token
+        self.token_handler = token_handler
+        self.token_expires = None
+        self.token_thread  = None
+        # Refresh when it's this close (seconds) to expiring.
+        self.token_margin  = 86400
+        self.last_selected = None
+        # The app or web UI can select another one, so only trust ours for
+        # this many seconds, and not at all after a failed call.
+        self.select_ttl    = 60
+        self.selected_time = 0
+        # Results of api_read_d are good for this many seconds.
+        self.cache_ttl     = cache_ttl
+        self.cache         = dict()
+        self.cache_flight  = dict()
+        self.cache_lock    = threading.Lock()
+        # Held from SelectTagManager through the call for it, commands run in
+        # parallel and can't select a different one in between.
+        self.select_lock   = threading.RLock()
+        self.cache_stats   = { 'hit': 0, 'miss': 0, 'collapse': 0 }
         self.client_id = client_id
         self.client_secret = client_secret
         self.ghandler=ghandler
@@ -138,18 +656,63 @@ class wtServer():
         self.token_type   = None
 
     def start(self):
-        self.rest = wtREST(self,self.logger)
-        self.st = self.rest.start()
-        if self.st is False:
-            self.l_error('wtServer:start','REST server not started {}'.format(self.st))
-            return False
+        if self.rest is not None:
+            # Events come in to the account that owns the REST server.
+            self.st = True
+        else:
+            if self.rest_process:
+                self.rest = wtRESTProcess(self,self.logger)
+            else:
+                self.rest = wtREST(self,self.logger)
+            self.st = self.rest.start(self.port)
+            if self.st is False:
+                self.l_error('wtServer:start','REST server not started {}'.format(self.st))
+                return False
+            if self.watchdog_interval > 0:
+                self.watchdog = wtRESTWatchdog(self.rest,self.logger,interval=self.watchdog_interval)
+                self.watchdog.start()
         self.listen_url  = self.rest.url
         self.listen_port = self.rest.listen_port
+        self.port_changed = self.rest.port_changed
         self.url = self.rest.url
         if self.oauth2_code != False:
-            self.get_access_token()
+            if not self.load_token():
+                self.get_access_token()
         return True
 
+    def load_token(self):
+        """
+        Use the token saved by token_handler last time if it's for the
+        same code and not expired, so we don't have to wait for a new one.
+        """
+        token = self.token
+        if token is None or token.get('code') != self.oauth2_code:
+            return False
+        if token['expires'] <= time.time():
+            self.l_info('load_token','Saved token expired at {0}'.format(time.ctime(token['expires'])))
+            return False
+        self.access_token  = token['access_token']
+        self.token_type    = token['token_type']
+        self.token_expires = token['expires']
+        self.l_info('load_token','Using saved token, expires {0}'.format(time.ctime(self.token_expires)))
+        return True
+
+    def check_token(self):
+        """
+        Get a new token in the background when the current one is close
+        to expiring.
+        """
+        if self.oauth2_code == False or self.token_expires is None:
+            return
+        if self.token_expires - time.time() > self.token_margin:
+            return
+        if self.token_thread is not None and self.token_thread.is_alive():
+            return
+        self.l_info('check_token','Token expires {0}, refreshing'.format(time.ctime(self.token_expires)))
+        self.token_thread = threading.Thread(target=self.get_access_token,kwargs={'keep':True})
+        self.token_thread.daemon = True
+        self.token_thread.start()
+
     def get_handler(self,command,params):
         """
         This is passed the incoming http get's to processes
@@ -157,6 +720,13 @@ class wtServer():
         self.l_debug('get_handler','command={}'.format(command))
         # This is from the oauth2 redirect with our code.
         if command == "/code":
+            # state is the account the code is for.
+            account = params.get('state',self.account)
+            if account != self.account:
+                if account in self.peers:
+                    return self.peers[account].get_handler(command,params)
+                self.l_error('get_handler','Got code for unknown account {0}'.format(account))
+                return { 'code': 500, 'message': 'Unknown account {0}'.format(account) }
             code = 200
             message = "\nGot code {}, asking for access token\n".format(params['code'])
             self.oauth2_code = params['code']
@@ -191,7 +761,24 @@ class wtServer():
             self.l_error('get_handler','code={0} message={1}'.format(code,message))
         return  { 'code': code, 'message': message }
 
-    def get_access_token(self,code=None):
+    def event_handler(self,command,params):
+        """
+        The tag events, what get_handler does for them without building
+        the messages.
+        """
+        if self.ghandler is None:
+            self.l_error('event_handler','Unknown command, no ghandler specified {0}'.format(command))
+            return False
+        ret = self.ghandler(command,params)
+        if not ret:
+            self.l_error('event_handler','Command {0} failed'.format(command))
+        return ret
+
+    def get_access_token(self,code=None,keep=False):
+        """
+        Exchange our code for an access token.  keep means hang on to the
+        current token if this fails, it's still good until it expires.
+        """
         if code is not None:
             self.oauth2_code = code
         aret = self.http_post('oauth2/access_token.aspx',
@@ -204,17 +791,113 @@ class wtServer():
         # {'token_type': 'Bearer', 'access_token': '...', 'expires_in': 9999999}
         if aret == False:
             self.l_error('get_access_token','Failed')
-            self.access_token = aret
+            if not keep:
+                self.access_token = aret
             return aret
         self.access_token = aret['access_token']
         self.token_type   = aret['token_type']
-        self.l_debug('start',"token_type={} access_token={}".format(self.token_type,self.access_token))
+        self.token_expires = time.time() + int(aret.get('expires_in',0))
+        self.l_debug('start',"token_type={} access_token={} expires={}".format(self.token_type,self.access_token,time.ctime(self.token_expires)))
+        self.token = {
+            'code':         self.oauth2_code,
+            'access_token': self.access_token,
+            'token_type':   self.token_type,
+            'expires':      self.token_expires,
+        }
+        if self.token_handler is not None:
+            self.token_handler(self.token)
+        return True
+
+    def http_post(self,path,payload,use_token=True,mac=None):
+        response = self.http_request(path,payload,use_token,mac=mac)
+        if response is False:
+            return False
+        #self.l_debug('http_post',"Got: text=%s" % response.text)
+        try:
+            d = json.loads(response.text)
+        except (Exception) as err:
+            self.l_error('http_post','Failed to convert to json {0}: {1}'.format(response.text,err), exc_info=True)
+            return False
+        return d
+
+    def http_post_stream(self,path,payload,key='d',use_token=True,mac=None):
+        """
+        Like http_post, but returns a generator of each entry in the key list
+        of the response as it is read, instead of loading it all at once.
+        """
+        response = self.http_request(path,payload,use_token,stream=True,mac=mac)
+        if response is False:
+            return False
+        return self.iter_response(response,key)
+
+    def iter_response(self,response,key):
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')('replace')
+        chunks = (decoder.decode(chunk) for chunk in response.iter_content(chunk_size=8192))
+        try:
+            for item in iter_json_list(chunks,key):
+                yield item
+        finally:
+            response.close()
 
-    def http_post(self,path,payload,use_token=True):
-        #url = "http://www.mytaglist.com/{}".format(path)
-        url = "http://wirelesstag.net/{}".format(path)
+    def set_lan_url(self,mgr_mac,url,retry=300):
+        """ Send ethClient calls for mgr_mac to the Tag Manager at url, None to stop """
+        if url is None:
+            self.lan_routes.pop(mgr_mac,None)
+        else:
+            self.lan_routes[mgr_mac] = wtRoute(mgr_mac,url,retry)
+
+    def get_route(self,path,mac=None):
+        """
+        The route for path, the LAN if the Tag Manager mac, or the selected one,
+        has one that's up.
+        """
+        if path.startswith('ethClient'):
+            route = self.lan_routes.get(self.last_selected if mac is None else mac)
+            if route is not None and route.available():
+                return route
+        return self.cloud
+
+    def get_route_stats(self):
+        """ { route name: { 'up': bool, 'paths': wtRoute.get_stats() } } """
+        stats = dict()
+        for route in [self.cloud] + list(self.lan_routes.values()):
+            stats[route.name] = { 'up': route.available(), 'paths': route.get_stats() }
+        return stats
+
+    def http_request(self,path,payload,use_token=True,stream=False,mac=None):
+        """
+        Post to path and check the status, returns the response or False.
+        ethClient calls are for the Tag Manager mac, or the selected one.
+        """
+        route = self.get_route(path,mac)
+        response = None
+        if route is not self.cloud:
+            response = self.http_route(route,path,payload,use_token,stream)
+            if response is None:
+                # It never got to the Tag Manager so the cloud can send it,
+                # after that it may have done it already.
+                self.l_warning('http_post','Tag Manager {0} failed on the LAN, using the cloud for {1} seconds'.format(route.name,route.retry))
+                route.set_down()
+                # It was only selected on the LAN, the cloud has to be told.
+                if not self.SelectTagManager(route.name)['st']:
+                    return False
+        if response is None:
+            response = self.http_route(self.cloud,path,payload,use_token,stream)
+        if response is None or response is False:
+            if path.startswith('ethClient'):
+                # Maybe it wasn't the one we think is selected.
+                self.last_selected = None
+            return False
+        return response
+
+    def http_route(self,route,path,payload,use_token=True,stream=False):
+        """
+        Post to path on route, returns the response, False for an error
+        response or if it failed after sending, or None if it couldn't connect.
+        """
+        url = route.base_url + path
         self.l_debug('http_post',"Sending: url={0} payload={1}".format(url,payload))
-        if use_token:
+        if use_token and route is self.cloud:
             if self.access_token is False:
                 self.l_error('http_post',"No authorization for url={0} payload={1}".format(url,payload))
                 return False
@@ -222,28 +905,29 @@ class wtServer():
                 "Authorization": "{0} {1}".format(self.token_type,self.access_token),
                 "Content-Type": "application/json"
             }
+        elif use_token:
+            # The Tag Manager on the LAN doesn't get our cloud token.
+            headers = { "Content-Type": "application/json" }
         else:
             headers = {}
+        stime = time.time()
         try:
-            response = requests.post(
+            response = self.session.post(
                 url,
                 headers=headers,
                 data=payload,
-                timeout=10
+                timeout=10,
+                stream=stream
             )
         # This is supposed to catch all request excpetions.
         except requests.exceptions.RequestException as e:
             self.l_error('http_post',"Connection error for %s: %s" % (url, e))
-            return False
+            route.record(path,time.time() - stime,False)
+            return None if not_sent(e) else False
+        route.record(path,time.time() - stime,response.status_code == 200)
         self.l_debug('http_post',' Got: code=%s' % (response.status_code))
         if response.status_code == 200:
-            #self.l_debug('http_post',"Got: text=%s" % response.text)
-            try:
-                d = json.loads(response.text)
-            except (Exception) as err:
-                self.l_error('http_post','Failed to convert to json {0}: {1}'.format(response.text,err), exc_info=True)
-                return False
-            return d
+            return response
         elif response.status_code == 400:
             self.l_error('http_post',"Bad request: %s" % (url) )
         elif response.status_code == 404:
@@ -254,6 +938,7 @@ class wtServer():
                 "Failed to authenticate, please check your username and password")
         else:
             self.l_error('http_post',"Unknown response %s: %s %s" % (response.status_code, url, response.text) )
+        response.close()
         return False
 
     def l_info(self, name, string):
@@ -271,40 +956,125 @@ class wtServer():
     """
     Wiress Tags API Functions
     """
-    def api_post_d(self,path,payload,dump=True):
+    def api_post_d(self,path,payload,dump=True,mac=None):
         """
         Call the api path with payload expecting data in d entry
         Return sttatus and result
         """
         if dump:
             payload = json.dumps(payload)
-        aret = self.http_post(path,payload)
-        self.l_debug('api_post_d','path={0} got={1}'.format(path,aret))
+        aret = self.http_post(path,payload,mac=mac)
         if aret == False or not 'd' in aret:
             mret = { 'st': False }
         else:
             mret = { 'st': True, 'result': aret['d'] }
-        self.l_debug('api_post_d','ret={0}'.format(mret))
+        # Don't format big results unless someone is going to see them.
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.l_debug('api_post_d','path={0} ret={1}'.format(path,mret))
+        return mret
+
+    def api_post_d_iter(self,path,payload,dump=True,mac=None):
+        """
+        Like api_post_d but result is a generator of the entries in the d list,
+        st is set to False if reading them fails, so check it when done.
+        """
+        if dump:
+            payload = json.dumps(payload)
+        items = self.http_post_stream(path,payload,mac=mac)
+        if items is False:
+            return { 'st': False }
+        mret = { 'st': True }
+        mret['result'] = self.iter_api(path,items,mret)
         return mret
 
+    def iter_api(self,path,items,mret):
+        cnt = 0
+        try:
+            for item in items:
+                cnt += 1
+                yield item
+        except (requests.exceptions.RequestException, ValueError) as err:
+            self.l_error('api_post_d_iter','path={0} failed after {1} entries: {2}'.format(path,cnt,err))
+            mret['st'] = False
+        self.l_debug('api_post_d_iter','path={0} got {1} entries'.format(path,cnt))
+
+    def api_read_d(self,path,payload,mac=None):
+        """
+        api_post_d for calls that don't change anything.  If the same call
+        is already running we wait for it's result instead of sending
+        another, and results are reused for cache_ttl seconds.
+        """
+        # ethClient calls are for the tag manager mac, or the selected one.
+        if path.startswith('ethClient'):
+            mac = self.last_selected if mac is None else mac
+        else:
+            mac = None
+        key = (path,json.dumps(payload,sort_keys=True),mac)
+        with self.cache_lock:
+            ent = self.cache.get(key)
+            if ent is not None and time.time() - ent[0] < self.cache_ttl:
+                self.cache_stats['hit'] += 1
+                return deepcopy(ent[1])
+            flight = self.cache_flight.get(key)
+            if flight is None:
+                self.cache_stats['miss'] += 1
+                flight = { 'event': threading.Event(), 'result': { 'st': False } }
+                self.cache_flight[key] = flight
+                leader = True
+            else:
+                self.cache_stats['collapse'] += 1
+                leader = False
+        if not leader:
+            flight['event'].wait()
+            return deepcopy(flight['result'])
+        try:
+            flight['result'] = self.api_post_d(path,payload,mac=mac)
+        finally:
+            with self.cache_lock:
+                if flight['result']['st'] and self.cache_ttl > 0:
+                    self.cache[key] = (time.time(),flight['result'])
+                del self.cache_flight[key]
+            flight['event'].set()
+        return deepcopy(flight['result'])
+
+    def cache_clear(self):
+        """ Called before anything that changes what api_read_d would return """
+        with self.cache_lock:
+            self.cache = dict()
+
+    def get_cache_stats(self):
+        with self.cache_lock:
+            return dict(self.cache_stats, size=len(self.cache))
+
     # These match the names used in the API
 
     # http://wirelesstag.net/ethAccount.asmx?op=IsSignedIn
     def IsSignedIn(self):
-        return self.api_post_d('ethAccount.asmx/IsSignedIn',{})
+        return self.api_read_d('ethAccount.asmx/IsSignedIn',{})
 
     # These match the names used in the API:
     # http://wirelesstag.net/ethAccount.asmx?op=GetTagManagers
     def GetTagManagers(self):
-        return self.api_post_d('ethAccount.asmx/GetTagManagers',{})
+        return self.api_read_d('ethAccount.asmx/GetTagManagers',{})
 
     # http://wirelesstag.net/ethAccount.asmx?op=SelectTagManager
     def SelectTagManager(self,mgr_mac):
         # This doesn't like how request converts dict to json, so do it here.
-        if hasattr(self,'last_selected') and self.last_selected == mgr_mac: return { 'st': True }
+        if self.last_selected == mgr_mac and time.time() - self.selected_time < self.select_ttl:
+            return { 'st': True }
+        route = self.lan_routes.get(mgr_mac)
+        if route is not None and route.available():
+            # Calls for it go to it on the LAN, so the cloud doesn't need to
+            # know, and this works when the internet is down.
+            self.last_selected = mgr_mac
+            self.selected_time = 0
+            return { 'st': True }
         mgd = self.api_post_d('ethAccount.asmx/SelectTagManager',{'mac':mgr_mac})
         if mgd['st']:
-            last_selected = mgr_mac
+            self.last_selected = mgr_mac
+            self.selected_time = time.time()
+        else:
+            self.last_selected = None
         return mgd
 
     # http://wirelesstag.net/ethClient.asmx?op=GetServerTime
@@ -312,51 +1082,67 @@ class wtServer():
         return self.api_post_d('ethClient.asmx/GetServerTime',{})
 
     # http://wirelesstag.net/ethClient.asmx?op=GetTagList
-    def GetTagList(self):
-        return self.api_post_d('ethClient.asmx/GetTagList',{})
+    # The ethClient calls are for the selected Tag Manager, mgr_mac says
+    # which one that is so they can go to it on the LAN.
+    def GetTagList(self,mgr_mac=None):
+        return self.api_read_d('ethClient.asmx/GetTagList',{},mac=mgr_mac)
+
+    # Same as GetTagList, but the tags are returned one at a time as they are read.
+    def GetTagListIter(self,mgr_mac=None):
+        return self.api_post_d_iter('ethClient.asmx/GetTagList',{},mac=mgr_mac)
 
     # http://wirelesstag.net/ethClient.asmx?op=LoadEventURLConfig
-    def LoadEventURLConfig(self,params):
-        return self.api_post_d('ethClient.asmx/LoadEventURLConfig',params)
+    def LoadEventURLConfig(self,params,mgr_mac=None):
+        return self.api_read_d('ethClient.asmx/LoadEventURLConfig',params,mac=mgr_mac)
 
     # http://wirelesstag.net/ethClient.asmx?op=SaveEventURLConfig
-    def SaveEventURLConfig(self,params):
-        return self.api_post_d('ethClient.asmx/SaveEventURLConfig',params)
+    def SaveEventURLConfig(self,params,mgr_mac=None):
+        self.cache_clear()
+        return self.api_post_d('ethClient.asmx/SaveEventURLConfig',params,mac=mgr_mac)
 
     # http://wirelesstag.net/ethClient.asmx?op=LoadTempSensorConfig
-    def LoadTempSensorConfig(self,params):
-        return self.api_post_d('ethClient.asmx/LoadTempSensorConfig',params)
+    def LoadTempSensorConfig(self,params,mgr_mac=None):
+        return self.api_post_d('ethClient.asmx/LoadTempSensorConfig',params,mac=mgr_mac)
 
     # http://wirelesstag.net/ethClient.asmx?op=GetTagListCached
     def DontUseThisGetTagListCached(self,params):
         return self.api_post_d('ethClient.asmx/GetTagListCached',params)
 
     # http://wirelesstag.net/ethClient.asmx?op=RequestImmediatePostback
-    def RequestImmediatePostback(self,params):
-        return self.api_post_d('ethClient.asmx/RequestImmediatePostback',params)
+    def RequestImmediatePostback(self,params,mgr_mac=None):
+        self.cache_clear()
+        return self.api_post_d('ethClient.asmx/RequestImmediatePostback',params,mac=mgr_mac)
 
     def RebootTagManager(self,mgr_mac):
-        ret = self.SelectTagManager(mgr_mac)
-        if ret['st']:
-            ret = self.api_post_d('ethClient.asmx/RebootTagManager',{})
+        self.cache_clear()
+        with self.select_lock:
+            ret = self.SelectTagManager(mgr_mac)
+            if ret['st']:
+                ret = self.api_post_d('ethClient.asmx/RebootTagManager',{},mac=mgr_mac)
         return ret
 
     def PingAllTags(self,mgr_mac):
-        ret = self.SelectTagManager(mgr_mac)
-        if ret['st']:
-            ret = self.api_post_d('ethClient.asmx/PingAllTags',{'autoRetry':True})
+        self.cache_clear()
+        with self.select_lock:
+            ret = self.SelectTagManager(mgr_mac)
+            if ret['st']:
+                ret = self.api_post_d('ethClient.asmx/PingAllTags',{'autoRetry':True},mac=mgr_mac)
         return ret
 
     def LightOn(self,mgr_mac,id,flash):
-        ret = self.SelectTagManager(mgr_mac)
-        if ret['st']:
-            ret = self.api_post_d('ethClient.asmx/LightOn',{'id': id, 'flash':flash})
+        self.cache_clear()
+        with self.select_lock:
+            ret = self.SelectTagManager(mgr_mac)
+            if ret['st']:
+                ret = self.api_post_d('ethClient.asmx/LightOn',{'id': id, 'flash':flash},mac=mgr_mac)
         return ret
 
     def LightOff(self,mgr_mac,id):
-        ret = self.SelectTagManager(mgr_mac)
-        if ret['st']:
-            ret = self.api_post_d('ethClient.asmx/LightOff',{'id': id})
+        self.cache_clear()
+        with self.select_lock:
+            ret = self.SelectTagManager(mgr_mac)
+            if ret['st']:
+                ret = self.api_post_d('ethClient.asmx/LightOff',{'id': id},mac=mgr_mac)
         return ret
 
 def my_ghandler(command,params):
@@ -0,0 +1,128 @@
+"""
+Export the tag readings as InfluxDB line protocol.
+
+Points are added to a bounded buffer and a background thread sends them in
+batches, when batch_size points are waiting or every flush_interval seconds,
+to one of:
+  udp://host:port
+  file:///path/to/file
+  http://host:port/write?db=wirelesstags  (or https)
+If the buffer is full new points are dropped and counted, the event path
+never waits on the destination.
+"""
+import time,threading,socket,requests
+from urllib import parse
+
+def escape_tag(value):
+    """ Escape a measurement, tag key or tag value """
+    return str(value).replace('\\','\\\\').replace(',','\\,').replace('=','\\=').replace(' ','\\ ')
+
+def make_line(measurement,tags,fields,ts=None):
+    """
+    One line protocol point, tags and fields are dicts, ts is seconds.
+    Numbers are written as floats, everything else as strings.
+    """
+    line = escape_tag(measurement)
+    for key in sorted(tags):
+        if tags[key] is None or tags[key] == '': continue
+        line += ',{0}={1}'.format(escape_tag(key),escape_tag(tags[key]))
+    values = list()
+    for key, value in fields.items():
+        if isinstance(value,bool) or not isinstance(value,(int,float)):
+            value = '"{0}"'.format(str(value).replace('\\','\\\\').replace('"','\\"'))
+        else:
+            value = repr(float(value))
+        values.append('{0}={1}'.format(escape_tag(key),value))
+    line += ' ' + ','.join(values)
+    if ts is not None:
+        line += ' {0}'.format(int(ts * 1e9))
+    return line
+
+class wtExporter():
+
+    def __init__(self,logger,url,measurement='wirelesstag',batch_size=500,flush_interval=10,max_buffer=10000,timeout=10):
+        self.logger         = logger
+        self.url            = url
+        self.measurement    = measurement
+        self.batch_size     = int(batch_size)
+        self.flush_interval = flush_interval
+        self.max_buffer     = int(max_buffer)
+        self.timeout        = timeout
+        self.buffer         = list()
+        self.cond           = threading.Condition()
+        self.stats          = { 'added': 0, 'sent': 0, 'dropped': 0, 'failed': 0, 'batches': 0 }
+        self.thread         = None
+        self.sock           = None
+        parsed = parse.urlparse(url)
+        self.scheme = parsed.scheme.lower()
+        if self.scheme == 'udp':
+            self.address = (parsed.hostname,parsed.port)
+        elif self.scheme == 'file':
+            self.address = parsed.path
+        elif self.scheme in ('http','https'):
+            self.address = url
+        else:
+            raise ValueError("Unknown export url '{0}', must be udp://, file:// or http(s)://".format(url))
+
+    def start(self):
+        if self.scheme == 'udp':
+            self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.thread = threading.Thread(target=self._sender,name='wtExporter')
+        self.thread.daemon = True
+        self.thread.start()
+        self.l_info('start','Exporting to {0}'.format(self.url))
+
+    def add(self,tags,fields,ts=None):
+        """ Add a point, returns False if it was dropped """
+        line = make_line(self.measurement,tags,fields,ts or time.time())
+        with self.cond:
+            if len(self.buffer) >= self.max_buffer:
+                self.stats['dropped'] += 1
+                return False
+            self.buffer.append(line)
+            self.stats['added'] += 1
+            if len(self.buffer) >= self.batch_size:
+                self.cond.notify()
+        return True
+
+    def flush(self):
+        """ Wake up the sender to send what's buffered now """
+        with self.cond:
+            self.cond.notify()
+
+    def _sender(self):
+        while True:
+            with self.cond:
+                if len(self.buffer) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+                batch = self.buffer
+                self.buffer = list()
+            # Stay under batch_size per send so UDP packets aren't huge.
+            for i in range(0,len(batch),self.batch_size):
+                self.send(batch[i:i+self.batch_size])
+
+    def send(self,lines):
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        try:
+            if self.scheme == 'udp':
+                self.sock.sendto(data,self.address)
+            elif self.scheme == 'file':
+                with open(self.address,'ab') as f:
+                    f.write(data)
+            else:
+                response = requests.post(self.address,data=data,timeout=self.timeout)
+                if response.status_code >= 300:
+                    raise IOError('http status {0}: {1}'.format(response.status_code,response.text[:200]))
+        except (OSError, requests.exceptions.RequestException) as err:
+            self.l_error('send','failed to send {0} points: {1}'.format(len(lines),err))
+            self.stats['failed'] += len(lines)
+            return False
+        self.stats['sent'] += len(lines)
+        self.stats['batches'] += 1
+        return True
+
+    def l_info(self, name, string):
+        self.logger.info("wtExporter:%s: %s" %  (name,string))
+
+    def l_error(self, name, string):
+        self.logger.error("wtExporter:%s: %s" % (name,string))
@@ -11,6 +11,93 @@ def id_to_address(address,slen=14):
     m.update(address.encode())
     return m.hexdigest()[slen:]
 
+def get_hash(data):
+    """ md5 of the json of data, keys are sorted so it's stable """
+    m = hashlib.md5()
+    m.update(json.dumps(data,sort_keys=True).encode())
+    return m.hexdigest()
+
+def iter_json_list(chunks,key='d'):
+    """
+    Yield each entry of the list in key of a json object, like {"d":[...]},
+    from the string chunks as they come in.  Only the current entry is kept
+    in memory, not the whole object.
+    """
+    decoder  = json.JSONDecoder()
+    ws_re    = re.compile(r'[\s,]*')
+    space_re = re.compile(r'\s*')
+    colon_re = re.compile(r'\s*(:?)\s*')
+    buf      = ''
+    pos      = 0
+    opened   = False
+    in_list  = False
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        # Walk the top level object a key and value at a time, so a key or
+        # bracket in a string or a nested object isn't taken for the list.
+        while not in_list:
+            start = ws_re.match(buf,pos).end()
+            if start >= len(buf):
+                break
+            if not opened:
+                if buf[start] != '{':
+                    raise ValueError('Not a json object: {0}'.format(buf[start:start+32]))
+                opened = True
+                pos = start + 1
+                continue
+            if buf[start] == '}':
+                raise ValueError('No list "{0}" in data'.format(key))
+            try:
+                name, end = decoder.raw_decode(buf,start)
+            except ValueError:
+                # Not all here yet
+                break
+            m = colon_re.match(buf,end)
+            end = m.end()
+            if end >= len(buf):
+                break
+            if m.group(1) == '':
+                raise ValueError('No : after {0}'.format(name))
+            if name == key:
+                if buf[end] != '[':
+                    raise ValueError('"{0}" is not a list'.format(key))
+                pos = end + 1
+                in_list = True
+                break
+            try:
+                value, end = decoder.raw_decode(buf,end)
+            except ValueError:
+                break
+            # A number may go on in the next chunk, it's all here when a , or } follows.
+            nxt = space_re.match(buf,end).end()
+            if nxt >= len(buf) or buf[nxt] not in ',}':
+                break
+            pos = end
+        if not in_list:
+            continue
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf,pos)
+            except ValueError:
+                # Not all here yet
+                break
+            # Only the , or ] after it says a number is all here.
+            nxt = space_re.match(buf,end).end()
+            if nxt >= len(buf) or buf[nxt] not in ',]':
+                break
+            pos = end
+            yield item
+    if in_list:
+        raise ValueError('Incomplete list "{0}" at end of data'.format(key))
+    raise ValueError('No list "{0}" in data'.format(key))
+
 def str_d(value):
     # Only allow utf-8 characters
     #  https://stackoverflow.com/questions/26541968/delete-every-non-utf-8-symbols-froms-string
@@ -62,4 +149,19 @@ def get_profile_info(logger):
         logger.error('get_profile_info: failed to read  file {0}: {1}'.format(pvf,err), exc_info=True)
         pv = 0
     f.close()
-    return { 'version': pv }
+    return { 'version': pv, 'hash': get_profile_hash(logger) }
+
+def get_profile_hash(logger,path='profile'):
+    """ md5 of every file in the profile, so we know if it really changed """
+    m = hashlib.md5()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for fname in sorted(files):
+            fname = os.path.join(root,fname)
+            m.update(fname.encode())
+            try:
+                with open(fname,'rb') as f:
+                    m.update(f.read())
+            except Exception as err:
+                logger.error('get_profile_hash: failed to read file {0}: {1}'.format(fname,err))
+    return m.hexdigest()
@@ -0,0 +1,172 @@
+"""
+Derived values kept up to date from each new tag reading.
+
+Every update is O(1), nothing keeps a history of readings:
+  - dew point from the temperature and humidity (Magnus formula)
+  - exponentially weighted average of the temperature
+  - slope in degrees per hour from an exponentially weighted linear regression
+  - minimum and maximum temperature since local midnight
+  - days until the battery is empty, see wtBatteryForecast
+The averages are weighted by time, not by number of readings, since tags
+report whenever they feel like it.
+"""
+import math,time
+
+def dew_point(temp,hum,degF=False):
+    """ Dew point in the same units as temp, None if hum is 0 or missing """
+    try:
+        temp = float(temp)
+        hum  = float(hum)
+    except (TypeError, ValueError):
+        return None
+    if hum <= 0: return None
+    if degF:
+        temp = (temp - 32.0) / 1.8
+    b, c = 17.62, 243.12
+    gamma = math.log(min(hum,100.0) / 100.0) + b * temp / (c + temp)
+    dp = c * gamma / (b - gamma)
+    if degF:
+        dp = dp * 1.8 + 32.0
+    return dp
+
+class wtMetrics():
+
+    def __init__(self,avg_minutes=30,slope_minutes=60):
+        # Time constants of the average and slope in seconds.
+        self.avg_tau   = max(avg_minutes,1) * 60.0
+        self.slope_tau = max(slope_minutes,1) * 60.0
+        self.last_ts   = None
+        self.avg       = None
+        # Weighted sums for the regression, times are relative to the last reading
+        self.s0 = self.st = self.sx = self.stt = self.stx = 0.0
+        self.day       = None
+        self.min       = None
+        self.max       = None
+
+    def update(self,temp,hum=None,degF=False,ts=None):
+        """
+        Add a temperature reading, returns a dict of the driver values:
+          GV15 dew point (only if hum is not None)
+          GV16 average, GV17 slope per hour, GV18 daily min, GV19 daily max
+        """
+        ts   = time.time() if ts is None else ts
+        temp = float(temp)
+        if self.last_ts is None:
+            self.avg = temp
+        else:
+            dt = max(ts - self.last_ts,0)
+            self.avg += (1.0 - math.exp(-dt / self.avg_tau)) * (temp - self.avg)
+            # Age the regression sums, then add the new point.
+            decay = math.exp(-dt / self.slope_tau)
+            self.s0 *= decay; self.st *= decay; self.sx *= decay; self.stt *= decay; self.stx *= decay
+            # Move the time origin to now so the sums stay small and don't lose precision.
+            self.stt -= 2 * dt * self.st - dt * dt * self.s0
+            self.stx -= dt * self.sx
+            self.st  -= dt * self.s0
+        self.last_ts = ts
+        # The new point is at t=0
+        self.s0  += 1.0
+        self.sx  += temp
+        day = time.localtime(ts)[:3]
+        if day != self.day:
+            self.day = day
+            self.min = self.max = temp
+        else:
+            self.min = min(self.min,temp)
+            self.max = max(self.max,temp)
+        values = {
+            'GV16': round(self.avg,2),
+            'GV17': round(self.slope(),2),
+            'GV18': round(self.min,1),
+            'GV19': round(self.max,1),
+        }
+        if hum is not None:
+            dp = dew_point(temp,hum,degF)
+            if dp is not None:
+                values['GV15'] = round(dp,1)
+        return values
+
+    def slope(self):
+        """ Degrees per hour, 0 until there are two readings at different times """
+        den = self.s0 * self.stt - self.st * self.st
+        if self.s0 < 2 or abs(den) < 1e-9:
+            return 0.0
+        return (self.s0 * self.stx - self.st * self.sx) / den * 3600.0
+
+class wtBatteryForecast():
+    """
+    Days until the battery is empty from a linear regression of the battery
+    percent over time.  Old samples fade out over tau_days so the rate
+    follows the battery as it ages, and a jump up means it was replaced so
+    we start over.  Samples closer than min_interval seconds are skipped so
+    a burst of events doesn't outweigh a quiet week.
+    """
+
+    def __init__(self,tau_days=90,min_interval=3600,state=None):
+        self.tau      = tau_days * 86400.0
+        self.interval = min_interval
+        self.dirty    = False
+        self.reset()
+        if state is not None:
+            self.set_state(state)
+
+    def reset(self):
+        self.last_ts  = None
+        self.last_pct = None
+        self.first_ts = None
+        # Weighted sums, times are in days relative to the last sample.
+        self.s0 = self.st = self.sx = self.stt = self.stx = 0.0
+        self.cnt = 0
+
+    def update(self,pct,ts=None):
+        """ Add a sample, returns False if it was skipped """
+        ts  = time.time() if ts is None else ts
+        pct = float(pct)
+        if self.last_pct is not None and pct > self.last_pct + 10:
+            # New battery
+            self.reset()
+        if self.last_ts is not None:
+            if ts - self.last_ts < self.interval:
+                return False
+            decay = math.exp(-(ts - self.last_ts) / self.tau)
+            dt = (ts - self.last_ts) / 86400.0
+            self.s0 *= decay; self.st *= decay; self.sx *= decay; self.stt *= decay; self.stx *= decay
+            self.stt -= 2 * dt * self.st - dt * dt * self.s0
+            self.stx -= dt * self.sx
+            self.st  -= dt * self.s0
+        else:
+            self.first_ts = ts
+        self.last_ts  = ts
+        self.last_pct = pct
+        self.s0  += 1.0
+        self.sx  += pct
+        self.cnt += 1
+        self.dirty = True
+        return True
+
+    def days_remaining(self,now=None,min_days=2,min_samples=3):
+        """ Estimated days until 0%, None if we don't know yet or it isn't dropping """
+        if self.cnt < min_samples or self.last_ts - self.first_ts < min_days * 86400:
+            return None
+        den = self.s0 * self.stt - self.st * self.st
+        if abs(den) < 1e-12:
+            return None
+        slope = (self.s0 * self.stx - self.st * self.sx) / den
+        if slope >= 0:
+            return None
+        # The fitted percent at the last sample, minus the time since then.
+        pct  = (self.sx - slope * self.st) / self.s0
+        now  = time.time() if now is None else now
+        days = pct / -slope - (now - self.last_ts) / 86400.0
+        return max(days,0.0)
+
+    def get_state(self):
+        self.dirty = False
+        return [self.last_ts, self.last_pct, self.first_ts, self.s0, self.st, self.sx, self.stt, self.stx, self.cnt]
+
+    def set_state(self,state):
+        try:
+            (self.last_ts, self.last_pct, self.first_ts, self.s0, self.st,
+             self.sx, self.stt, self.stx, self.cnt) = state
+        except (TypeError, ValueError):
+            self.reset()
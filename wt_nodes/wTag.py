@@ -6,11 +6,18 @@ import polyinterface
 import sys
 import time
 import re
+import threading
 from copy import deepcopy
+from contextlib import contextmanager
+from functools import partial
 from wt_funcs import id_to_address,myfloat
+from wt_metrics import wtMetrics,wtBatteryForecast
+from wt_schema import get_tag_drivers,has_metrics
 
 LOGGER = polyinterface.LOGGER
 DLEV = 0
+# The tag each thread is applying new readings to, see setDriver
+applying = threading.local()
 
 class wTag(polyinterface.Node):
     """
@@ -90,78 +97,36 @@ class wTag(polyinterface.Node):
         self.tag_id = tag_id
         self.tag_type = tag_type
         self.primary_n = controller.nodes[primary]
-        #
-        # C or F?
-        # Fix our temp_uom in drivers
+        # Last time we asked for a RequestImmediatePostback
+        self.postback_time = 0
+        # The drivers for our tag type and units, see wt_schema.
         # This won't change an existing tag, only new ones.
-        #
-        # TODO:  test changing it by forcing update?
-        temp_uom = 4 if self.tag_uom == 0 else 17
-        dv = [
-            {'driver': 'ST',      'value': 0, 'uom': 2},
-             # tag_id
-            {'driver': 'GPV',     'value': self.tag_id, 'uom': 56},
-            # UOM 0=C 1=F
-            {'driver': 'UOM',     'value': 0, 'uom': 56},
-            # tag_type:
-            {'driver': 'GV1',     'value': self.tag_type, 'uom': 56},
-            # temp:   Curent temperature (17=F 4=C)
-            {'driver': 'CLITEMP', 'value': 0, 'uom': temp_uom},
-            # batp:   Battery percent (51=percent)
-            {'driver': 'BATLVL',  'value': 0, 'uom': 51},
-            # batv:   Battery Voltag 72=Volt
-            {'driver': 'CV',      'value': 0, 'uom': 72},
-            # lit:    Light
-            {'driver': 'GV7',     'value': 0, 'uom': 25},
-            # tempState:
-            {'driver': 'GV9',     'value': 0, 'uom': 25},
-            # time:
-            {'driver': 'GV13',     'value': 0, 'uom': 25},
-            # seconds since update
-            {'driver': 'GV14',     'value': 0, 'uom': 25},
-        ]
-
-        if (tag_type == 12 or tag_type == 13 or tag_type == 21 or tag_type == 26
-            or tag_type == 32 or tag_type == 52 or tag_type == 62 or
-            tag_type == 72):
-            # evst: Event State
-            dv.append({'driver': 'ALARM',   'value': 0, 'uom': 25})
-        if (tag_type == 26):
-            # lux:    Lux (36=lux)
-            dv.append({'driver': 'LUMIN',   'value': 0, 'uom': 36})
-        if (tag_type == 13 or tag_type == 21 or tag_type == 26 or tag_type == 32
-            or tag_type == 52 or tag_type == 62 or tag_type == 72):
-            # hum:    Humidity (21 = absolute humidity)
-            dv.append({'driver': 'CLIHUM',  'value': 0, 'uom': 22})
-        if (tag_type == 12 or tag_type == 13 or tag_type == 21):
-            # motion: Might use True, False, Open for door mode?
-            dv.append({'driver': 'GV2',     'value': 0, 'uom': 25})
-            # orien:  Orientation
-            dv.append({'driver': 'GV3',     'value': 0, 'uom': 56})
-            # xaxis:  X-Axis
-            dv.append({'driver': 'GV4',     'value': 0, 'uom': 56})
-            # yasis:  Y-Axis
-            dv.append({'driver': 'GV5',     'value': 0, 'uom': 56})
-            # zaxis:  Z-Axis
-            dv.append({'driver': 'GV6',     'value': 0, 'uom': 56})
-        if (tag_type == 12 or tag_type == 13 or tag_type == 21 or tag_type == 26
-            or tag_type == 32 or tag_type == 52 or tag_type == 72):
-            # oor:    OutOfRange
-            dv.append({'driver': 'GV8',     'value': 0, 'uom':  2})
-            # signaldBm:
-            dv.append({'driver': 'CC',     'value': 0, 'uom':  56})
-        if (tag_type == 13 or tag_type == 21 or tag_type == 26
-            or tag_type == 32 or tag_type == 52 or tag_type == 62
-            or tag_type == 72):
-            # moisture(cap)State:
-            dv.append({'driver': 'GV10',    'value': 0, 'uom': 25})
-        if (tag_type == 26):
-            # lightState:
-            dv.append({'driver': 'GV11',    'value': 0, 'uom': 25})
-        if (tag_type == 32):
-            # TODO: Only 32 has water sensor?
-            dv.append({'driver': 'GV12',  'value': 1, 'uom': 25})
-        self.drivers = dv
+        derived_metrics = controller.derived_metrics and has_metrics(tag_type)
+        self.drivers = get_tag_drivers(tag_type,self.tag_uom,derived_metrics)
+        names = [d['driver'] for d in self.drivers]
+        if derived_metrics:
+            # Derived from the temperature (and humidity), see wt_metrics
+            self.metrics = wtMetrics(controller.get_float_param('metrics_avg_minutes',30),
+                                     controller.get_float_param('metrics_slope_minutes',60))
+            self.metrics_hum = 'CLIHUM' in names
+        else:
+            self.metrics = None
+        self.metrics_temp = None
+        self.battery = wtBatteryForecast(state=controller.get_custom_data('battery',dict()).get(address))
+        self.battery_pct = None
+        self.battery_low = 0
+        # Light state, set by set_lit, and the number of the last light command.
+        self.lit = None
+        self.light_seq = 0
+        # Set by the controller when we are added in bulk, see flush_reports
+        self.defer_reports = False
+        self.started = False
+        # Collapsing bursts of motion and door events, see get_handler
+        self.burst_lock    = threading.Lock()
+        self.burst_until   = 0
+        self.burst_pending = None
+        self.burst_id      = 0
+        self.temp_param = self.temp_params.get(self.tag_uom)
         uomS = "C" if self.tag_uom == 0 else "F"
         self.id = 'wTag' + str(self.tag_type) + uomS
         self.address = address
@@ -178,6 +143,7 @@ class wTag(polyinterface.Node):
         self.set_tag_type(self.tag_type)
         self.set_tag_id(self.tag_id)
         self.set_tag_uom(self.tag_uom)
+        self.get_set_batl()
         if self.tdata is not None:
             self.set_from_tag_data(self.tdata)
         else:
@@ -202,12 +168,16 @@ class wTag(polyinterface.Node):
             self.get_set_list()
             self.get_set_wtst()
             self.set_time_now()
-        if self.controller.update_profile:
+        if self.defer_reports:
+            # The controller reports for all the new tags at once when they are started.
+            pass
+        elif self.controller.update_profile:
             # Drivers were updated, need to query
             self.query()
         else:
             # Otherwise just report previous values
             self.reportDrivers()
+        self.started = True
 
     def shortPoll(self):
         self.set_seconds()
@@ -222,11 +192,30 @@ class wTag(polyinterface.Node):
         #self.set_tag_type(self.tag_type,True)
         #self.set_tag_id(self.tag_id,True)
         #self.set_tag_uom(self.tag_uom,True)
-        # This askes for the sensor to report
-        mgd = self.controller.wtServer.RequestImmediatePostback({'id':self.tag_id})
+        # The tag manager collects these so a query of many tags is one request.
+        self.primary_n.query_tag(self)
+
+    def postback(self):
+        """
+        Ask the tag to report now, returns False if we did one too recently.
+        """
+        interval = self.controller.postback_interval
+        if interval > 0 and time.time() - self.postback_time < interval:
+            self.l_debug('postback','last was {0:.1f} seconds ago, limit is {1}'.format(time.time() - self.postback_time,interval))
+            return False
+        self.postback_time = time.time()
+        # This askes for the sensor to report, it has to be our tag manager that's selected.
+        server = self.primary_n.wtServer
+        with server.select_lock:
+            mgd = server.SelectTagManager(self.primary_n.mac)
+            if mgd['st']:
+                mgd = server.RequestImmediatePostback({'id':self.tag_id},self.primary_n.mac)
+            else:
+                self.l_error('postback',"Unable to select tag manager: {}".format(self.primary_n.mac))
         if mgd['st']:
             self.set_from_tag_data(mgd['result'])
             self.reportDrivers()
+        return True
 
     def l_info(self, name, string):
         LOGGER.info("%s:%s:%s:%s:%s: %s" %  (self.primary_n.name,self.name,self.address,self.id,name,string))
@@ -244,104 +233,253 @@ class wTag(polyinterface.Node):
         """
         This is called by the controller get_handler after parsing the node_data
         """
-        if command == '/update':
-            #tagname=Garage Freezer&tagid=0&temp=-21.4213935329179&hum=0&lux=0&ts=2018-02-15T11:18:02+00:00 HTTP/1.1" 400 -
-            pass
-        elif command == '/motion_detected':
-            self.set_motion(1)
-        elif command == '/motion_timedout':
-            self.set_motion(0)
-        elif command == '/door_opened':
-            self.set_motion(2)
-        elif command == '/door_closed':
-            self.set_motion(4)
-        elif command == '/door_open_toolong':
-            self.set_motion(2)
-        elif command == '/oor':
-            self.set_oor(1)
-        elif command == '/back_in_range':
-            self.set_oor(0)
-        elif command == '/temp_normal':
-            self.set_tmst(1)
-        elif command == '/temp_toohigh':
-            self.set_tmst(2)
-        elif command == '/temp_toolow':
-            self.set_tmst(3)
-        elif command == '/too_humid':
-            self.set_cpst(4)
-        elif command == '/too_dry':
-            self.set_cpst(3)
-        elif command == '/cap_normal':
-            self.set_cpst(2)
-        elif command == '/water_detected':
-            self.set_wtst(2)
-        elif command == '/water_dried':
-            self.set_wtst(1)
-        elif command == '/low_battery':
-            self.set_batl(1)
-        elif command == '/too_bright':
-            self.set_list(4)
-        elif command == '/too_dark':
-            self.set_list(3)
-        elif command == '/light_normal':
-            self.set_list(2)
-        else:
-            self.l_error('get_handler',"Unknown command '{0}'".format(command))
-        if 'tempc' in params and self.tag_uom == 0:
-            self.set_temp(params['tempc'],convert=False)
-        if 'tempf' in params and self.tag_uom == 1:
-            self.set_temp(params['tempf'],convert=False)
-        if 'temp' in params:
-            self.set_temp(params['temp'])
-        if 'hum' in params:
-            self.set_hum(params['hum'])
-        if 'lux' in params:
-            self.set_lux(params['lux'])
-        if 'orien' in params:
-            self.set_orien(params['orien'])
-        if 'xaxis' in params:
-            self.set_xaxis(params['xaxis'])
-        if 'yaxis' in params:
-            self.set_yaxis(params['yaxis'])
-        if 'zaxis' in params:
-            self.set_zaxis(params['zaxis'])
-        self.set_time_now()
+        if self.controller.store is not None:
+            self.controller.store.add_event(self.address,command[1:])
+        window = self.controller.collapse_windows.get(command)
+        if window is None:
+            with self.burst_lock:
+                # A collapsed event still waiting is older than this one, so
+                # it goes now instead of landing on top of it later.
+                self.apply_pending()
+                return self.apply_event(command,params)
+        # The first motion/door event is applied now, the rest until the window
+        # ends are collapsed into the last one which is applied when it does.
+        with self.burst_lock:
+            if window > 0 and time.time() < self.burst_until:
+                if self.burst_pending is not None:
+                    self.set_collapsed(self.burst_pending[0])
+                self.burst_pending = (command,params)
+                return True
+            if self.burst_pending is not None:
+                # This one is newer than what's waiting.
+                self.set_collapsed(self.burst_pending[0])
+                self.burst_pending = None
+            self.start_burst(window)
+            return self.apply_event(command,params)
+
+    def start_burst(self,window):
+        self.burst_until = time.time() + window
+        # Only the timer for the latest window does anything.
+        self.burst_id += 1
+        if window > 0:
+            timer = threading.Timer(window,self.end_burst,args=(self.burst_id,))
+            timer.daemon = True
+            timer.start()
+
+    def end_burst(self,burst_id):
+        # This is the timer thread, take the REST event lock so it's applied
+        # in order with the events coming in, like they are.
+        with self.primary_n.wtServer.rest.lock:
+            with self.burst_lock:
+                if self.burst_pending is None or burst_id != self.burst_id:
+                    return
+                self.start_burst(self.controller.collapse_windows.get(self.burst_pending[0],0))
+                self.apply_pending()
+
+    def apply_pending(self):
+        """ Apply the collapsed event that's waiting, traced like it came in now """
+        if self.burst_pending is None:
+            return
+        command, params = self.burst_pending
+        self.burst_pending = None
+        latency = self.controller.latency
+        if latency is None:
+            return self.apply_event(command,params)
+        with latency.tracing(command,params):
+            return self.apply_event(command,params)
+
+    def set_collapsed(self,command):
+        stats = self.controller.collapse_stats
+        stats[command[1:]] = stats.get(command[1:],0) + 1
+
+    def apply_event(self,command,params):
+        with self.applying():
+            # /update is in the table with None, it only has the readings.
+            event = self.event_setters.get(command,False)
+            if event is False:
+                self.l_error('get_handler',"Unknown command '{0}'".format(command))
+            elif event is not None:
+                getattr(self,event[0])(event[1])
+            # Temperature from the event is already in our units.
+            value = params.get(self.temp_param)
+            if value is not None:
+                self.set_temp(value,convert=False)
+            for param, setter in self.param_setters:
+                value = params.get(param)
+                if value is not None:
+                    getattr(self,setter)(value)
+            self.set_time_now()
         return True
 
+    # Event to the (setter, value) for it.
+    event_setters = {
+        #tagname=Garage Freezer&tagid=0&temp=-21.4213935329179&hum=0&lux=0&ts=2018-02-15T11:18:02+00:00 HTTP/1.1" 400 -
+        '/update':            None,
+        '/motion_detected':   ('set_motion', 1),
+        '/motion_timedout':   ('set_motion', 0),
+        '/door_opened':       ('set_motion', 2),
+        '/door_closed':       ('set_motion', 4),
+        '/door_open_toolong': ('set_motion', 2),
+        '/oor':               ('set_oor', 1),
+        '/back_in_range':     ('set_oor', 0),
+        '/temp_normal':       ('set_tmst', 1),
+        '/temp_toohigh':      ('set_tmst', 2),
+        '/temp_toolow':       ('set_tmst', 3),
+        '/too_humid':         ('set_cpst', 4),
+        '/too_dry':           ('set_cpst', 3),
+        '/cap_normal':        ('set_cpst', 2),
+        '/water_detected':    ('set_wtst', 2),
+        '/water_dried':       ('set_wtst', 1),
+        '/low_battery':       ('set_batl', 1),
+        '/too_bright':        ('set_list', 4),
+        '/too_dark':          ('set_list', 3),
+        '/light_normal':      ('set_list', 2),
+    }
+    # Event param with the temperature for each tag_uom
+    temp_params = { 0: 'tempc', 1: 'tempf' }
+    # Event params, and the setter for them, in the order they are set.
+    param_setters = (
+        ('temp',  'set_temp'),
+        ('hum',   'set_hum'),
+        ('lux',   'set_lux'),
+        ('orien', 'set_orien'),
+        ('xaxis', 'set_xaxis'),
+        ('yaxis', 'set_yaxis'),
+        ('zaxis', 'set_zaxis'),
+    )
+
+    @contextmanager
+    def applying(self):
+        """
+        Drivers set inside this are new readings from the tag, not values
+        restored at startup, so setDriver saves them in the store.
+        """
+        prev = getattr(applying,'tag',None)
+        applying.tag = self
+        try:
+            yield
+        finally:
+            applying.tag = prev
+        if prev is not self:
+            if self.metrics is not None:
+                self.set_metrics()
+            if self.battery_pct is not None:
+                self.set_battery()
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        if self.defer_reports:
+            report = False
+        if getattr(applying,'tag',None) is not self or not driver in self.store_drivers:
+            return super(wTag, self).setDriver(driver, value, report, force, uom)
+        if driver == 'CLITEMP':
+            self.metrics_temp = value
+        elif driver == 'BATLVL':
+            self.battery_pct = value
+        exporter = self.controller.exporter
+        if exporter is not None:
+            current = next((d['value'] for d in self.drivers if d['driver'] == driver), None)
+            changed = str(current) != str(value)
+        super(wTag, self).setDriver(driver, value, report, force, uom)
+        if self.controller.latency is not None:
+            self.controller.latency.driver_set(self.address,driver,value)
+        if self.controller.store is not None:
+            self.controller.store.add_reading(self.address,driver,value)
+        if exporter is not None and changed:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return
+            exporter.add(
+                {'address': self.address, 'name': self.name, 'tmgr_mac': self.primary_n.mac, 'tag_type': self.tag_type},
+                {driver: value})
+
+    def flush_reports(self):
+        """ Send the drivers that changed while reports were deferred """
+        self.defer_reports = False
+        for driver in self.drivers:
+            self.reportDriver(driver, True, False)
+
+    def reportDriver(self, driver, report, force):
+        # Same as polyinterface, but sent through the publisher so alarms go first.
+        publisher = self.controller.publisher
+        if publisher is None:
+            return super(wTag, self).reportDriver(driver, report, force)
+        for d in self._drivers:
+            if (d['driver'] == driver['driver'] and
+                (str(d['value']) != str(driver['value']) or d['uom'] != driver['uom'] or force)):
+                d['value'] = deepcopy(driver['value'])
+                d['uom']   = deepcopy(driver['uom'])
+                publisher.publish(self.address,driver['driver'],driver['value'],driver['uom'])
+                break
+
+    def reportDrivers(self):
+        publisher = self.controller.publisher
+        if publisher is None:
+            return super(wTag, self).reportDrivers()
+        self.l_debug('reportDrivers','Updating All Drivers to ISY for {}({})'.format(self.name, self.address))
+        # Only a change goes in with the alarms, the rest can coalesce.
+        sent = dict((d['driver'], str(d['value'])) for d in self._drivers)
+        self.updateDrivers(self.drivers)
+        for driver in self.drivers:
+            publisher.publish(self.address,driver['driver'],driver['value'],driver['uom'],
+                              changed=sent.get(driver['driver']) != str(driver['value']))
+
+    # Drivers saved in the store and exported, the others are ids or times.
+    store_drivers = ('ST','CLITEMP','CLIHUM','LUMIN','BATLVL','CV','GV2','GV3','GV4','GV5','GV6',
+                     'GV7','ALARM','GV8','CC','GV9','GV10','GV11','GV12')
+
     """
     Set Functions
     """
     def set_from_tag_data(self,tdata):
-        if 'alive' in tdata:
-            self.set_alive(tdata['alive'])
-        if 'temperature' in tdata:
-            self.set_temp(tdata['temperature'])
-        if 'batteryVolt' in tdata:
-            self.set_batv(tdata['batteryVolt'])
-        if 'batteryRemaining' in tdata:
-            self.set_batp(float(tdata['batteryRemaining']) * 100)
-        if 'lux' in tdata:
-            self.set_lux(tdata['lux'])
-        if 'cap' in tdata:
-            self.set_hum(tdata['cap'])
-        if 'lit' in tdata:
-            self.set_lit(tdata['lit'])
-        if 'eventState' in tdata:
-            self.set_evst(tdata['eventState'])
-        if 'oor' in tdata:
-            self.set_oor(tdata['oor'])
-        if 'signaldBm' in tdata:
-            self.set_signaldbm(tdata['signaldBm'])
-        if 'tempEventState' in tdata:
-            self.set_tmst(tdata['tempEventState'])
-        if 'capEventState' in tdata:
-            self.set_cpst(tdata['capEventState'])
-        if 'lightEventState' in tdata:
-            self.set_list(tdata['lightEventState'])
-        # This is the last time the tag manager has heard from the tag?
-        if 'lastComm' in tdata:
-            self.set_time(tdata['lastComm'],wincrap=True)
-            self.set_seconds()
+        with self.applying():
+            if 'alive' in tdata:
+                self.set_alive(tdata['alive'])
+            if 'temperature' in tdata:
+                self.set_temp(tdata['temperature'])
+            if 'batteryVolt' in tdata:
+                self.set_batv(tdata['batteryVolt'])
+            if 'batteryRemaining' in tdata:
+                self.set_batp(float(tdata['batteryRemaining']) * 100)
+            if 'lux' in tdata:
+                self.set_lux(tdata['lux'])
+            if 'cap' in tdata:
+                self.set_hum(tdata['cap'])
+            if 'lit' in tdata:
+                self.set_lit(tdata['lit'])
+            if 'eventState' in tdata:
+                self.set_evst(tdata['eventState'])
+            if 'oor' in tdata:
+                self.set_oor(tdata['oor'])
+            if 'signaldBm' in tdata:
+                self.set_signaldbm(tdata['signaldBm'])
+            if 'tempEventState' in tdata:
+                self.set_tmst(tdata['tempEventState'])
+            if 'capEventState' in tdata:
+                self.set_cpst(tdata['capEventState'])
+            if 'lightEventState' in tdata:
+                self.set_list(tdata['lightEventState'])
+            # This is the last time the tag manager has heard from the tag?
+            if 'lastComm' in tdata:
+                self.set_time(tdata['lastComm'],wincrap=True)
+                self.set_seconds()
+
+    def set_metrics(self):
+        # Only when there was a new temperature.
+        temp, self.metrics_temp = self.metrics_temp, None
+        if temp is None: return
+        hum = None
+        if self.metrics_hum:
+            # Our current value, getDriver is what Polyglot last saved.
+            hum = next(d['value'] for d in self.drivers if d['driver'] == 'CLIHUM')
+        try:
+            values = self.metrics.update(temp,hum,self.tag_uom == 1)
+        except (TypeError, ValueError) as err:
+            self.l_error('set_metrics','temp={0} hum={1}: {2}'.format(temp,hum,err))
+            return
+        self.l_debug('set_metrics','{0}'.format(values))
+        for driver, value in values.items():
+            self.setDriver(driver, value)
 
     # This is the tag_type number, we don't really need to show it, but
     # we need the info when recreating the tags from the config.
@@ -359,6 +497,8 @@ class wTag(polyinterface.Node):
         self.l_debug('set_tag_uom','UOM to {0}'.format(value))
         self.tag_uom = value
         self.setDriver('UOM', value)
+        # The event temperature param in our units, if we know them.
+        self.temp_param = self.temp_params.get(value)
 
     def get_set_alive(self):
         self.set_alive(self.getDriver('ST'))
@@ -396,7 +536,8 @@ class wTag(polyinterface.Node):
 
     def set_lit(self,value):
         self.l_debug('set_lit','{0}'.format(value))
-        self.setDriver('GV7', int(value))
+        self.lit = int(value)
+        self.setDriver('GV7', self.lit)
 
     def get_set_lux(self):
         # Get current value, if None then we don't have this driver.
@@ -427,10 +568,37 @@ class wTag(polyinterface.Node):
     def set_batv(self,value):
         self.setDriver('CV', myfloat(value,3))
 
+    def get_set_batl(self):
+        value = self.getDriver('GV21')
+        if value is None: return
+        self.set_battery_low(int(value))
+
     def set_batl(self,value,force=False):
-        # TODO: Implement battery low!
-        return
-        self.setDriver('CV', value)
+        # The tag says it's low, stays that way until the battery is replaced.
+        self.l_debug('set_batl','{0}'.format(value))
+        self.set_battery_low(2 if int(value) else 0)
+
+    def set_battery_low(self,value):
+        self.battery_low = value
+        self.setDriver('GV21', value)
+
+    def set_battery(self):
+        pct, self.battery_pct = self.battery_pct, None
+        try:
+            if not self.battery.update(pct):
+                return
+        except (TypeError, ValueError) as err:
+            self.l_error('set_battery','pct={0}: {1}'.format(pct,err))
+            return
+        days = self.battery.days_remaining()
+        self.l_debug('set_battery','pct={0} days={1}'.format(pct,days))
+        self.setDriver('GV20', -1 if days is None else int(days))
+        if self.battery.cnt == 1:
+            # Just started over with a new battery
+            self.set_battery_low(0)
+        elif self.battery_low != 2:
+            low = days is not None and days < self.controller.battery_low_days
+            self.set_battery_low(1 if low else 0)
 
     def get_set_motion(self):
         # Get current value, if None then we don't have this driver.
@@ -606,19 +774,33 @@ class wTag(polyinterface.Node):
 
     def cmd_set_light(self,command):
         value = int(command.get("value"))
-        # Save current value, and change it.
-        slit = self.lit
-        self.set_lit(value)
+        server = self.primary_n.wtServer
         if value == 0:
-            ret = self.controller.wtServer.LightOff(self.primary_n.mac,self.tag_id)
+            target, args = server.LightOff, (self.primary_n.mac,self.tag_id)
         elif value == 1:
-            ret = self.controller.wtServer.LightOn(self.primary_n.mac,self.tag_id,False)
+            target, args = server.LightOn, (self.primary_n.mac,self.tag_id,False)
         elif value == 2:
-            ret = self.controller.wtServer.LightOn(self.primary_n.mac,self.tag_id,True)
-        if ret['st']:
-            self.set_from_tag_data(ret['result'])
+            target, args = server.LightOn, (self.primary_n.mac,self.tag_id,True)
         else:
-            # Command failed, restore status
+            self.l_error('cmd_set_light','Unknown value {0}'.format(value))
+            return
+        # Show it now, the cloud call is done by a worker, after any
+        # command still running for this tag.
+        slit = 0 if self.lit is None else self.lit
+        self.set_lit(value)
+        self.light_seq += 1
+        self.controller.submit_command('set_light',target,args,serial=self.address,
+                                       reconcile=partial(self.set_light_done,self.light_seq),
+                                       rollback=partial(self.set_light_failed,self.light_seq,slit))
+
+    def set_light_done(self,seq,ret):
+        # A newer command has already set the status it wants.
+        if seq == self.light_seq:
+            self.set_from_tag_data(ret['result'])
+
+    def set_light_failed(self,seq,slit):
+        # Restore the status, unless another command changed it since.
+        if seq == self.light_seq:
             self.set_lit(slit)
 
     commands = {
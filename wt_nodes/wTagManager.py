@@ -5,10 +5,11 @@ by JimBoCA jimboca3@gmail.com
 import polyinterface
 import sys
 import time
-from threading import Thread
-from wt_funcs import get_valid_node_name
-from wt_params import wt_params
+from threading import Timer,Lock
+from wt_funcs import get_valid_node_name,get_hash
+from wt_params import wt_params,wt_json_template
 from wt_nodes import wTag
+from wt_tasks import PRIORITY_LOW
 
 LOGGER = polyinterface.LOGGER
 
@@ -50,11 +51,18 @@ class wTagManager(polyinterface.Node):
         self.do_discover = do_discover
         self.node_data   = node_data
         self.mac         = mac
+        # The account we are in, and it's wtServer
+        self.account     = controller.get_manager_account(mac)
+        self.wtServer    = controller.get_server(self.account)
         super(wTagManager, self).__init__(controller, address, address, name)
-        # These start in threads cause they take a while
-        self.discover_thread = None
-        self.set_url_thread = None
+        # These run as tasks cause they take a while
         self.set_url_config_st = None
+        # Tags waiting for query_tags
+        self.query_lock  = Lock()
+        self.query_queue = dict()
+        self.query_timer = None
+        # Used for event keys we don't know about
+        self.def_param = '0={0}&1={1}&2={2}'
 
     def start(self):
         """
@@ -71,9 +79,11 @@ class wTagManager(polyinterface.Node):
             self.set_use_tags(self.getDriver('GV1'))
             self.l_info("start",'{0} {1}'.format(self._drivers,self.use_tags))
         self.degFC = 1 # I like F.
-        # When we are added by the controller discover, then run our discover.
+        # When we are added by the controller discover, then run our discover,
+        # in a task since it waits for Polyglot to add the tags and we are
+        # on the thread that handles that.
         if self.do_discover:
-            self.discover(thread=False)
+            self.discover(thread=True)
         else:
             self.add_existing_tags()
             #self.discover() # Needed to fix tag_id's
@@ -88,21 +98,67 @@ class wTagManager(polyinterface.Node):
         the parent class, so you don't need to override this method unless
         there is a need.
         """
-        mgd = self.controller.wtServer.GetTagList()
-        if mgd['st']:
-            self.set_st(False)
-            for tag in mgd['result']:
-                tag_o = self.get_tag_by_id(tag['slaveId'])
-                if tag_o is None:
-                    self.l_error('query','No tag with id={0}'.format(tag['slaveId']))
-                else:
-                    tag_o.set_from_tag_data(tag)
-                    tag_o.reportDrivers()
-        else:
-            self.set_st(False)
+        # Tags are handled as they are read so we never hold the whole list,
+        # and no one can select another tag manager until we're done.
+        with self.wtServer.select_lock:
+            ret = self.wtServer.SelectTagManager(self.mac)
+            if ret['st'] is False:
+                self.l_error('query',"Unable to select tag manager: {}".format(self.mac))
+                mgd = ret
+            else:
+                mgd = self.wtServer.GetTagListIter(self.mac)
+            if mgd['st']:
+                for tag in mgd['result']:
+                    tag_o = self.get_tag_by_id(tag['slaveId'])
+                    if tag_o is None:
+                        self.l_error('query','No tag with id={0}'.format(tag['slaveId']))
+                    else:
+                        tag_o.set_from_tag_data(tag)
+                        tag_o.reportDrivers()
+        self.set_st(mgd['st'])
         self.reportDrivers()
 
 
+    def query_tag(self,tag):
+        """
+        Called by the tag query, waits query_window seconds for others so
+        they can all be done in one request.
+        """
+        with self.query_lock:
+            self.query_queue[tag.address] = tag
+            if self.query_timer is None:
+                self.query_timer = Timer(self.controller.query_window,self.query_tags)
+                self.query_timer.daemon = True
+                self.query_timer.start()
+
+    def query_tags(self):
+        with self.query_lock:
+            tags = list(self.query_queue.values())
+            self.query_queue = dict()
+            self.query_timer = None
+        self.l_debug('query_tags','{0}'.format([tag.name for tag in tags]))
+        if len(tags) == 1 and tags[0].postback():
+            return
+        # More than one, or too soon for a postback, so update them all from the tag list.
+        by_id = dict()
+        for tag in tags:
+            by_id[int(tag.tag_id)] = tag
+        # Commands for other tag managers can't select them until we're done.
+        with self.wtServer.select_lock:
+            ret = self.wtServer.SelectTagManager(self.mac)
+            if ret['st'] is False:
+                self.set_st(False)
+                self.l_error('query_tags',"Unable to select tag manager: {}".format(self.mac))
+                return
+            mgd = self.wtServer.GetTagListIter(self.mac)
+            if mgd['st']:
+                for tdata in mgd['result']:
+                    tag = by_id.get(int(tdata['slaveId']))
+                    if tag is not None:
+                        tag.set_from_tag_data(tdata)
+                        tag.reportDrivers()
+        self.set_st(mgd['st'])
+
     def shortPoll(self):
         """
         Optional.
@@ -111,23 +167,15 @@ class wTagManager(polyinterface.Node):
         The timer can be overriden in the server.json.
         """
         if not self.ready: return False
-        if self.discover_thread is not None:
-            if self.discover_thread.isAlive():
-                self.l_debug('shortPoll','discover thread still running...')
-            else:
-                self.l_debug('shortPoll','discover thread is done...')
-                self.discover_thread = None
-        if self.set_url_thread is not None:
-            if self.set_url_thread.isAlive():
-                self.l_debug('shortPoll','set_url thread still running...')
-            else:
-                self.l_debug('shortPoll','set_url thread is done...')
-                self.set_url_thread = None
-        if self.discover_thread is None and self.set_url_thread is None:
-            if self.set_url_config_st == False:
-                # Try again...
-                self.l_error('shortPoll',"Calling set_url_config since previous st={}".format(self.set_url_config_st))
-                self.set_url_config()
+        tasks = self.controller.tasks
+        if tasks.running(self.task_key('discover')):
+            self.l_debug('shortPoll','discover still running...')
+        elif tasks.running(self.task_key('set_url_config')):
+            self.l_debug('shortPoll','set_url_config still running...')
+        elif self.set_url_config_st == False:
+            # Try again...
+            self.l_error('shortPoll',"Calling set_url_config since previous st={}".format(self.set_url_config_st))
+            self.set_url_config()
         for tag in self.get_tags():
             tag.shortPoll()
 
@@ -141,16 +189,17 @@ class wTagManager(polyinterface.Node):
         if not self.ready: return False
         self.l_debug('longPoll','...')
         if self.st is False:
-            ret = self.controller.wtServer.SelectTagManager(self.mac)
+            with self.wtServer.select_lock:
+                ret = self.wtServer.SelectTagManager(self.mac)
             self.set_st(ret['st'])
 
     def discover(self, thread=False):
         """
-        Start the discover in a thread so we don't cause timeouts :(
+        Start the discover in a task so we don't cause timeouts :(
         """
         if thread:
-            self.discover_thread = Thread(target=self._discover)
-            self.discover_thread.start()
+            self.controller.tasks.submit('discover',self._discover,key=self.task_key('discover'),
+                                         callback=self.controller.task_done)
         else:
             self._discover()
 
@@ -161,10 +210,11 @@ class wTagManager(polyinterface.Node):
         ret = self.get_tag_list()
         if ret['st'] is False:
             return
-        index = 0
+        tags = list()
         for tag in ret['result']:
             self.l_debug('discover','Got Tag: {}'.format(tag))
-            self.add_tag(tdata=tag, uom=self.get_tag_temp_unit(tag))
+            tags.append(self.make_tag(tdata=tag, uom=self.get_tag_temp_unit(tag)))
+        self.controller.bulk_add_nodes(tags,'discover')
         self.reportDrivers() # Report now so they show up while set_url runs.
         self.set_url_config(thread=False)
 
@@ -186,9 +236,13 @@ class wTagManager(polyinterface.Node):
         self.set_url_config()
 
     def add_tag(self, address=None, name=None, tag_type=None, uom=None, tdata=None, node_data=None, update=False):
-        return self.controller.addNode(wTag(self.controller, self.address, address,
-        name=name, tag_type=tag_type, uom=uom, tdata=tdata, node_data=node_data),
-        update=update)
+        return self.controller.addNode(self.make_tag(address=address, name=name, tag_type=tag_type,
+                                                     uom=uom, tdata=tdata, node_data=node_data),
+                                       update=update)
+
+    def make_tag(self, address=None, name=None, tag_type=None, uom=None, tdata=None, node_data=None):
+        return wTag(self.controller, self.address, address,
+                    name=name, tag_type=tag_type, uom=uom, tdata=tdata, node_data=node_data)
 
 
     """
@@ -200,7 +254,12 @@ class wTagManager(polyinterface.Node):
         """
         Returns the LoadTempSensorConfig temp_unit.  0 = Celcius, 1 = Fahrenheit
         """
-        mgd = self.controller.load_temp_sensor_config(tag_data['slaveId'])
+        # Our account's server, and us selected, not the default account's.
+        with self.wtServer.select_lock:
+            mgd = self.wtServer.SelectTagManager(self.mac)
+            if mgd['st']:
+                mgd = self.wtServer.LoadTempSensorConfig({'id': tag_data['slaveId']},self.mac)
+        self.controller.set_comm(mgd['st'])
         if mgd['st']:
             return mgd['result']['temp_unit']
         else:
@@ -232,11 +291,11 @@ class wTagManager(polyinterface.Node):
     """
     def set_url_config(self, thread=True):
         """
-        Start the set_url_config in a thread so we don't cause timeouts :(
+        Start the set_url_config in a task so we don't cause timeouts :(
         """
         if thread:
-            self.set_url_thread = Thread(target=self._set_url_config)
-            self.set_url_thread.start()
+            self.controller.tasks.submit('set_url_config',self._set_url_config,key=self.task_key('set_url_config'),
+                                         priority=PRIORITY_LOW,callback=self.controller.task_done)
         else:
             self._set_url_config()
 
@@ -250,44 +309,108 @@ class wTagManager(polyinterface.Node):
         if len(tags) == 0:
             self.l_error("_set_url_config","No tags in Polyglot DB, you need to discover?")
             return False
-        def_param = '0={0}&1={1}&2={2}'
-        mgd = self.controller.wtServer.LoadEventURLConfig({'id':tags[0].tag_id})
-        self.l_debug('set_url_config','{0}'.format(mgd))
-        if mgd['st'] is False:
-            self.set_url_config_st = False
-            return False
-        else:
-            url = self.controller.wtServer.listen_url
+        newconfig = self.get_url_config()
+        chash = get_hash(newconfig)
+        tag_ids = sorted([int(tag.tag_id) for tag in tags])
+        last = self.get_url_config_hash()
+        if last is not None and last['hash'] == chash and last['tags'] == tag_ids:
+            # Same listener and same tags as the last successful save, nothing to do.
+            self.l_info('set_url_config','unchanged hash={0}, skipping'.format(chash))
+            self.set_url_config_st = True
+            return True
+        # Our tag manager has to stay selected from the load through the save.
+        with self.wtServer.select_lock:
+            mgd = self.wtServer.SelectTagManager(self.mac)
+            if mgd['st'] is False:
+                self.l_error('set_url_config',"Unable to select tag manager: {}".format(self.mac))
+                self.set_url_config_st = False
+                return False
+            mgd = self.wtServer.LoadEventURLConfig({'id':tags[0].tag_id},self.mac)
+            self.l_debug('set_url_config','{0}'.format(mgd))
+            if mgd['st'] is False:
+                self.set_url_config_st = False
+                return False
+            # We only load the config of the first tag, so if there are tags
+            # we have not saved before they all need to be written.
+            full = last is None or last['tags'] != tag_ids
             #{'in_free_fall': {'disabled': True, 'nat': False, 'verb': None, 'url': 'http://', 'content': None}
-            newconfig = dict()
+            config = dict()
             for key, value in mgd['result'].items():
                 if key != '__type':
-                    if key in wt_params:
-                        param = wt_params[key]
+                    if key in newconfig:
+                        want = newconfig[key]
                     else:
                         self.l_error('set_url_config',"Unknown tag param '{0}'".format(key))
-                        param = def_param
+                        want = self.get_url_config_entry(key,self.def_param)
                     self.l_debug('set_url_config',"key={0} value={1}".format(key,value))
-                    value['disabled'] = False
-                    value['url'] = '{0}/{1}?tmgr_mac={2}&{3}'.format(url,key,self.mac,param)
-                    value['nat'] = True
-                    newconfig[key] = value
-            # Changed to applyAll True for now?
-            res = self.controller.wtServer.SaveEventURLConfig({'id':tags[0].tag_id, 'config': newconfig, 'applyAll': True})
-            self.set_url_config_st = res['st']
+                    if full or any(value.get(k) != v for k, v in want.items()):
+                        value.update(want)
+                        config[key] = value
+            if len(config) == 0:
+                self.l_info('set_url_config','no changes for hash={0}'.format(chash))
+                st = True
+            else:
+                self.l_info('set_url_config','saving {0} of {1} entries full={2}'.format(len(config),len(mgd['result'])-1,full))
+                # Changed to applyAll True for now?
+                res = self.wtServer.SaveEventURLConfig({'id':tags[0].tag_id, 'config': config, 'applyAll': True},self.mac)
+                st = res['st']
+        if st:
+            self.set_url_config_hash({'hash': chash, 'tags': tag_ids})
+        self.set_url_config_st = st
+        return st
+
+    def get_url_config(self):
+        """
+        The event URL config we want on the tags for our listener.
+        """
+        config = dict()
+        for key in wt_params:
+            if self.controller.event_mode == 'POST':
+                config[key] = {
+                    'disabled': False,
+                    'url': '{0}/event'.format(self.wtServer.listen_url),
+                    'nat': True,
+                    'verb': 'POST',
+                    'content': wt_json_template(key,self.mac),
+                }
+            else:
+                config[key] = self.get_url_config_entry(key,wt_params[key])
+        return config
+
+    def get_url_config_entry(self,key,param):
+        return {
+            'disabled': False,
+            'url': '{0}/{1}?tmgr_mac={2}&{3}'.format(self.wtServer.listen_url,key,self.mac,param),
+            'nat': True,
+            'verb': None,
+            'content': None,
+        }
+
+    def get_url_config_hash(self):
+        return self.controller.get_custom_data('url_config',{}).get(self.mac)
+
+    def set_url_config_hash(self,value):
+        cfg = dict(self.controller.get_custom_data('url_config',{}))
+        cfg[self.mac] = value
+        self.controller.set_custom_data('url_config',cfg)
+
+    def task_key(self,name):
+        """ Key for our tasks, so each one only runs once per tag manager """
+        return (self.mac,name)
 
     def get_tag_list(self):
-        ret = self.controller.wtServer.SelectTagManager(self.mac)
+        with self.wtServer.select_lock:
+            ret = self.wtServer.SelectTagManager(self.mac)
+            if ret['st'] is False:
+                self.set_st(False)
+                self.l_error('get_tag_list',"Unable to select tag manager: {}".format(self.mac))
+                return ret
+            ret = self.wtServer.GetTagList(self.mac)
         if ret['st'] is False:
             self.set_st(False)
-            self.l_error('get_tag_list',"Unable to select tag manager: {}".format(self.mac))
+            self.l_error('get_tag_list',"Unable to select get tags")
         else:
-            ret = self.controller.wtServer.GetTagList()
-            if ret['st'] is False:
-                self.set_st(False)
-                self.l_error('get_tag_list',"Unable to select get tags")
-            else:
-                self.set_st(True)
+            self.set_st(True)
         return ret
 
     def l_info(self, name, string):
@@ -329,6 +452,10 @@ class wTagManager(polyinterface.Node):
         self.setDriver('GV1', value)
         if self.ready and value == 1:
             self.discover()
+        elif value == 0:
+            # No point running these anymore
+            self.controller.tasks.cancel(self.task_key('discover'))
+            self.controller.tasks.cancel(self.task_key('set_url_config'))
 
     """
     """
@@ -337,10 +464,12 @@ class wTagManager(polyinterface.Node):
         self.set_use_tags(command.get("value"))
 
     def cmd_ping_all_tags(self,command):
-        self.controller.wtServer.PingAllTags(self.mac)
+        self.controller.submit_command('ping_all_tags',self.wtServer.PingAllTags,(self.mac,),
+                                       key=self.task_key('ping_all_tags'))
 
     def cmd_reboot(self,command):
-        self.controller.wtServer.RebootTagManager(self.mac)
+        self.controller.submit_command('reboot',self.wtServer.RebootTagManager,(self.mac,),
+                                       key=self.task_key('reboot'))
 
     def cmd_set_on(self, command):
         """
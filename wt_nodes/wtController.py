@@ -1,12 +1,21 @@
 
 import polyinterface
 import sys,time,logging
-from threading import Thread
+from functools import partial
+from threading import Lock
 from copy import deepcopy
 
 from wt_nodes import wTagManager
+from wt_nodes import wTag
 from wtServer import wtServer
+from wt_profiler import wtProfiler
+from wt_tasks import wtTaskExecutor,PRIORITY_HIGH
+from wt_store import wtStore
+from wt_export import wtExporter
+from wt_publish import wtPublisher
+from wt_trace import wtLatency
 from wt_funcs import get_server_data,get_valid_node_name,get_profile_info
+from wt_schema import make_profile
 
 LOGGER = polyinterface.LOGGER
 # old
@@ -52,7 +61,21 @@ class wtController(polyinterface.Controller):
         to override the __init__ method, but if you do, you MUST call super.
         """
         self.ready = False
-        self.discover_thread = None
+        self.tasks = None
+        # wtServer for each account by name, the default one has the REST server.
+        self.servers = dict()
+        self.account_status = dict()
+        self.store = None
+        self.exporter = None
+        self.publisher = None
+        self.latency = None
+        # Motion and door events suppressed by collapse_events, by event.
+        self.collapse_stats = dict()
+        # Latency of the ISY commands run by submit_command, by command.
+        self.command_stats = dict()
+        self.tag_index = dict()
+        self.profiler = wtProfiler(LOGGER)
+        self.custom_data_lock = Lock()
         self.serverdata = get_server_data(LOGGER)
         self.l_info('init','Initializing VERSION=%s' % (self.serverdata['version']))
         super(wtController, self).__init__(polyglot)
@@ -72,13 +95,39 @@ class wtController(polyinterface.Controller):
         """
         self.l_info('start','WirelessSensorTags Polyglot...')
         self.load_params()
-        self.wtServer = wtServer(LOGGER,self.client_id,self.client_secret,self.get_handler,self.oauth2_code)
+        self.tasks = wtTaskExecutor(LOGGER,self.get_float_param('task_workers',4))
+        if self.db_file != '':
+            store = wtStore(LOGGER,self.db_file,raw_days=self.get_float_param('db_days',7))
+            if store.start():
+                self.store = store
+        if self.export_url != '':
+            try:
+                self.exporter = wtExporter(LOGGER,self.export_url,
+                                           batch_size=self.get_float_param('export_batch',500),
+                                           flush_interval=self.get_float_param('export_interval',10))
+                self.exporter.start()
+            except ValueError as err:
+                self.l_error('start',str(err))
+                self.exporter = None
+        # Tag driver updates go to Polyglot through this, alarms first.
+        self.publisher = wtPublisher(LOGGER,self.poly.send,low_rate=self.get_float_param('publish_low_rate',20))
+        self.publisher.start()
+        self.latency = wtLatency(LOGGER,trace=self.trace_events)
+        self.wtServer = wtServer(LOGGER,self.client_id,self.client_secret,self.get_handler,self.oauth2_code,port=self.get_listen_port(),rest_process=self.rest_process,
+                                 token=self.get_custom_data('token'),token_handler=self.save_token,
+                                 cache_ttl=self.get_float_param('cache_ttl',5),watchdog=self.get_float_param('rest_watchdog',0.5))
         try:
             self.wtServer.start()
         except KeyboardInterrupt:
             # TODO: Should we set a flag so poll can just restart the server, instead of exiting?
             logger.info('Exiting from keyboard interupt')
             sys.exit()
+        self.servers = { 'default': self.wtServer }
+        self.start_accounts()
+        for mac, url in self.lan_urls.items():
+            self.l_info('start','Tag Manager {0} on the LAN at {1}'.format(mac,url))
+            for server in self.servers.values():
+                server.set_lan_url(mac,url,self.get_float_param('lan_retry',300))
         self.setDriver('GV1', self.serverdata['version_major'])
         self.setDriver('GV2', self.serverdata['version_minor'])
         self.debug_mode     = self.getDriver('GV5')
@@ -102,6 +151,10 @@ class wtController(polyinterface.Controller):
         self.long_poll = val
         if self.wtServer.st:
             self.set_port(self.wtServer.listen_port,True)
+            if self.wtServer.port_changed:
+                self.l_warning('start','Unable to use port {0}, tag URLs will be updated for port {1}'.format(self.wtServer.port,self.wtServer.listen_port))
+            if self.get_custom_data('listen_port') != self.wtServer.listen_port:
+                self.set_custom_data('listen_port',self.wtServer.listen_port)
         else:
             self.set_port(-1)
         self.save_params()
@@ -112,20 +165,53 @@ class wtController(polyinterface.Controller):
         self.l_info('start','done')
 
     def check_profile(self):
+        # Make sure the generated parts match wt_schema
+        try:
+            changed = make_profile()
+        except Exception as err:
+            self.l_error('check_profile','failed to generate profile: {0}'.format(err))
+            changed = list()
+        if len(changed) > 0:
+            self.l_warning('check_profile','Generated {0}'.format(changed))
         self.profile_info = get_profile_info(LOGGER)
-        # Set Default profile version if not Found
-        cdata = deepcopy(self.polyConfig['customData'])
-        self.l_info('check_profile','profile_info={0} customData={1}'.format(self.profile_info,cdata))
-        if not 'profile_info' in cdata:
-            cdata['profile_info'] = { 'version': 0 }
-        if self.profile_info['version'] == cdata['profile_info']['version']:
+        old_info = self.get_custom_data('profile_info',{ 'version': 0 })
+        self.l_info('check_profile','profile_info={0} old={1}'.format(self.profile_info,old_info))
+        # Only install when the content changed, installing makes every tag query.
+        if self.profile_info['hash'] == old_info.get('hash'):
             self.update_profile = False
         else:
             self.update_profile = True
             self.poly.installprofile()
         self.l_info('check_profile','update_profile={}'.format(self.update_profile))
-        cdata['profile_info'] = self.profile_info
-        self.saveCustomData(cdata)
+        if self.profile_info != old_info:
+            self.set_custom_data('profile_info',self.profile_info)
+
+    def get_custom_data(self,key,default=None):
+        return self.polyConfig['customData'].get(key,default)
+
+    def set_custom_data(self,key,value):
+        """
+        Save one entry in customData, the tag managers call this from their
+        threads so make sure they don't clobber each other.
+        """
+        with self.custom_data_lock:
+            cdata = deepcopy(self.polyConfig['customData'])
+            cdata[key] = value
+            self.polyConfig['customData'] = cdata
+            self.saveCustomData(cdata)
+
+    def save_battery(self):
+        """
+        Save the battery forecasts that changed, tags only sample once an
+        hour so this doesn't save much.
+        """
+        tags = [node for node in list(self.nodes.values()) if hasattr(node,'battery') and node.battery.dirty]
+        if len(tags) == 0: return
+        cdata = deepcopy(self.get_custom_data('battery',dict()))
+        for node in tags:
+            cdata[node.address] = node.battery.get_state()
+        self.l_debug('save_battery','{0} tags'.format(len(tags)))
+        self.set_custom_data('battery',cdata)
 
     def shortPoll(self):
         """
@@ -134,12 +220,8 @@ class wtController(polyinterface.Controller):
         or longPoll. No need to Super this method the parent version does nothing.
         The timer can be overriden in the server.json.
         """
-        if self.discover_thread is not None:
-            if self.discover_thread.isAlive():
-                self.l_debug('shortPoll','discover thread still running...')
-            else:
-                self.l_debug('shortPoll','discover thread is done...')
-                self.discover_thread = None
+        if self.tasks is not None and self.tasks.running('discover'):
+            self.l_debug('shortPoll','discover still running...')
         # Call short poll on the tags managers
         for address in self.nodes:
             if self.nodes[address].id == 'wTagManager':
@@ -155,13 +237,39 @@ class wtController(polyinterface.Controller):
         """
         self.l_debug('longPoll','ready={}'.format(self.ready))
         if not self.ready: return False
+        self.save_battery()
+        if self.store is not None:
+            self.l_info('longPoll','store stats {0}'.format(self.store.stats))
+        if self.exporter is not None:
+            self.l_info('longPoll','export stats {0}'.format(self.exporter.stats))
+        if self.publisher is not None:
+            self.l_info('longPoll','publish stats {0} pending {1}'.format(self.publisher.get_stats(),self.publisher.pending()))
+        if self.latency is not None:
+            self.l_info('longPoll','latency ms {0}'.format(self.latency.get_stats()))
+        if len(self.command_stats) > 0:
+            self.l_info('longPoll','command stats {0}'.format(self.get_command_stats()))
+        if len(self.collapse_stats) > 0:
+            self.l_info('longPoll','collapsed events {0}'.format(self.collapse_stats))
+        if self.wtServer.watchdog is not None:
+            self.l_info('longPoll','REST watchdog stats {0}'.format(self.wtServer.watchdog.get_stats()))
+        # Each account is polled in it's own task so a slow one doesn't hold up the others.
+        for account in self.servers:
+            self.tasks.submit('longPoll',self.poll_account,args=(account,),key=('longPoll',account),
+                              callback=self.task_done)
+
+    def poll_account(self,account):
+        server = self.servers[account]
+        server.check_token()
+        self.l_info('poll_account','{0} cache stats {1}'.format(account,server.get_cache_stats()))
+        self.l_info('poll_account','{0} route stats {1}'.format(account,server.get_route_stats()))
         # For now just pinging the serverto make sure it's alive
-        self.is_signed_in()
-        if not self.comm: return self.comm
+        if not self.is_signed_in(account): return False
         # Call long poll on the tags managers
-        for address in self.nodes:
-            if self.nodes[address].id == 'wTagManager':
-                self.nodes[address].longPoll()
+        for address in list(self.nodes):
+            node = self.nodes[address]
+            if node.id == 'wTagManager' and node.account == account:
+                node.longPoll()
+        return True
 
     def query(self):
         """
@@ -191,12 +299,110 @@ class wtController(polyinterface.Controller):
             else:
                 self.l_error('add_existing_tag_managers','node has no {0}? node={1}'.format(nodedef,node))
 
+    def addNode(self, node, update=False):
+        # Same as polyinterface, but through add_nodes so there is one copy of it.
+        return self.add_nodes([node])[0]
+
+    def add_nodes(self,nodes):
+        """
+        addNode for a list of nodes, in one message to Polyglot.
+        """
+        for node in nodes:
+            if node.address in self._nodes:
+                node._drivers = self._nodes[node.address]['drivers']
+                for driver in node.drivers:
+                    for existing in self._nodes[node.address]['drivers']:
+                        if driver['driver'] == existing['driver']:
+                            driver['value'] = existing['value']
+            self.nodes[node.address] = node
+            self.nodesAdding.append(node.address)
+        self.poly.send({ 'addnode': { 'nodes': [{
+            'address':     node.address,
+            'name':        node.name,
+            'node_def_id': node.id,
+            'primary':     node.primary,
+            'drivers':     node.drivers,
+            'hint':        node.hint,
+        } for node in nodes] } })
+        return nodes
+
+    def bulk_add_nodes(self,nodes,name='bulk_add_nodes'):
+        """
+        Add nodes in batches of add_batch, at most add_rate nodes a second.
+        Their driver reports are held until they have all started, then
+        only the ones that changed are sent.  Returns the number started.
+        """
+        batch_size = max(1,int(self.get_float_param('add_batch',10)))
+        rate       = max(0.1,self.get_float_param('add_rate',10))
+        total      = len(nodes)
+        for node in nodes:
+            node.defer_reports = True
+        for i in range(0,total,batch_size):
+            batch = nodes[i:i+batch_size]
+            self.add_nodes(batch)
+            self.l_info(name,'Added {0}/{1} nodes'.format(min(i+batch_size,total),total))
+            time.sleep(len(batch) / rate)
+        # Wait for Polyglot to tell us they were added and they are started.
+        etime = time.time() + self.get_float_param('add_timeout',60)
+        while time.time() < etime and not all(node.started for node in nodes):
+            time.sleep(0.5)
+        started = [node for node in nodes if node.started]
+        if len(started) < total:
+            self.l_error(name,'Only {0}/{1} nodes started'.format(len(started),total))
+        for node in nodes:
+            node.flush_reports()
+        self.l_info(name,'Reported {0} nodes'.format(total))
+        return len(started)
+
     def discover(self, *args, **kwargs):
         """
-        Start the discover in a thread so we don't cause timeouts :(
+        Start the discover in a task so we don't cause timeouts :(
+        """
+        self.tasks.submit('discover',self._discover,key='discover',callback=self.task_done)
+
+    def task_done(self,task):
+        if task.cancelled:
+            self.l_info('task_done','{0} cancelled'.format(task))
+        elif task.error is not None:
+            self.l_error('task_done','{0} failed after {1:.2f} seconds: {2}'.format(task,task.elapsed(),task.error))
+        else:
+            self.l_info('task_done','{0} result={1} in {2:.2f} seconds'.format(task,task.result,task.elapsed()))
+
+    def submit_command(self,name,target,args=(),key=None,reconcile=None,rollback=None,serial=None):
+        """
+        Run the cloud call for an ISY command on the task workers so the
+        Polyglot thread can go on to the next one.  When it's done
+        reconcile(result) is called if it worked, otherwise rollback().
+        Commands with the same serial, like the node address, run in order.
         """
-        self.discover_thread = Thread(target=self._discover)
-        self.discover_thread.start()
+        return self.tasks.submit(name,target,args=args,key=key,priority=PRIORITY_HIGH,serial=serial,
+                                 callback=partial(self.command_done,name,reconcile,rollback))
+
+    def command_done(self,name,reconcile,rollback,task):
+        ok = task.error is None and not task.cancelled and isinstance(task.result,dict) and task.result.get('st',False)
+        # From when ISY asked, so it includes waiting for a worker.
+        elapsed = (task.etime or time.time()) - task.qtime
+        st = self.command_stats.get(name)
+        if st is None:
+            st = self.command_stats[name] = { 'count': 0, 'failed': 0, 'total': 0.0, 'max': 0.0 }
+        st['count'] += 1
+        st['total'] += elapsed
+        st['max']    = max(st['max'],elapsed)
+        if ok:
+            self.l_info('command_done','{0} done in {1:.2f} seconds'.format(task,elapsed))
+            if reconcile is not None:
+                reconcile(task.result)
+        else:
+            st['failed'] += 1
+            self.l_error('command_done','{0} failed after {1:.2f} seconds: {2}'.format(task,elapsed,task.error or task.result))
+            if rollback is not None:
+                rollback()
+
+    def get_command_stats(self):
+        """ { command: { count, failed, avg, max } } in seconds """
+        return dict((name, { 'count': st['count'], 'failed': st['failed'],
+                             'avg': round(st['total'] / st['count'],3), 'max': round(st['max'],3) })
+                    for name, st in list(self.command_stats.items()))
 
     def _discover(self):
         """
@@ -204,15 +410,19 @@ class wtController(polyinterface.Controller):
         Do discovery here. Does not have to be called discovery. Called from example
         controller start method and from DISCOVER command recieved from ISY as an exmaple.
         """
-        if not self.authorized('discover') : return False
-        self.set_auth(True)
         self.save_params()
-        mgd = self.get_tag_managers()
-        if not 'macs' in self.polyConfig['customData']:
-            self.polyConfig['customData']['macs'] = dict()
+        for account in self.servers:
+            if self.servers[account].oauth2_code == False:
+                self.l_info('discover','Account {0} is not authorized'.format(account))
+                continue
+            self.discover_account(account)
+
+    def discover_account(self,account):
+        mgd = self.get_tag_managers(account)
         if mgd['st']:
             for mgr in mgd['result']:
-                self.l_debug("discover","TagManager={0}".format(mgr))
+                self.l_debug("discover","{0} TagManager={1}".format(account,mgr))
+                self.set_manager_account(mgr['mac'],account)
                 address = mgr['mac'].lower()
                 node = self.get_node(address)
                 if node is None:
@@ -252,10 +462,12 @@ class wtController(polyinterface.Controller):
         if not 'tmgr_mac' in params:
             self.l_error('get_handler','tmgr_mac not in params? command={0} params={1}'.format(command,params))
             return False
-        for address in self.nodes:
-            tnode = self.nodes[address]
-            if hasattr(tnode,'tag_id') and int(tnode.tag_id) == int(params['tagid']) and tnode.primary_n.mac == params['tmgr_mac']:
-                node = self.nodes[address]
+        key  = (params['tmgr_mac'],int(params['tagid']))
+        node = self.tag_index.get(key)
+        if node is None or self.nodes.get(node.address) is not node:
+            # New or replaced tag, rebuild the index.
+            self.tag_index = self.get_tag_index()
+            node = self.tag_index.get(key)
         if node is None:
             self.l_error('get_handler',"Did not find node for tag manager '{0}' with id '{1}'".format(params['tmgr_mac'],params['tagid']))
             for address in self.nodes:
@@ -263,11 +475,23 @@ class wtController(polyinterface.Controller):
                 if hasattr(tnode,'tag_id'):
                     self.l_debug('get_handler',' tmgr_mac={0} tagid={1}'.format(tnode.primary_n.mac,tnode.tag_id))
             return False
-        return node.get_handler(command,params)
+        if self.latency is None:
+            return node.get_handler(command,params)
+        with self.latency.tracing(command,params):
+            return node.get_handler(command,params)
 
     """
      Misc funcs
     """
+    def get_tag_index(self):
+        """ Tag nodes by (tag manager mac, tag id) for get_handler """
+        index = dict()
+        for address in list(self.nodes):
+            tnode = self.nodes[address]
+            if hasattr(tnode,'tag_id'):
+                index[(tnode.primary_n.mac,int(tnode.tag_id))] = tnode
+        return index
+
     def authorized(self,name):
         if self.wtServer.oauth2_code == False:
             self.set_auth(False)
@@ -275,24 +499,37 @@ class wtController(polyinterface.Controller):
             return False
         return True
 
-    def is_signed_in(self):
-        if not self.authorized('is_signed_in'):
+    def is_signed_in(self,account='default'):
+        server = self.get_server(account)
+        if server.oauth2_code == False:
+            self.l_error('is_signed_in',"Account {0} is not authorized".format(account))
+            self.set_account_status(account,False,False)
             return False
-        mgd = self.wtServer.IsSignedIn()
+        mgd = server.IsSignedIn()
         if 'result' in mgd:
             st = mgd['result']
-            self.set_comm(True)
+            comm = True
         else:
-            st = False
             # Didn't even get a response.
-            self.set_comm(st)
-        self.l_debug('is_signed_in','{0}'.format(st))
-        self.set_auth(st)
+            st = comm = False
+        self.l_debug('is_signed_in','{0} {1}'.format(account,st))
+        self.set_account_status(account,st,comm)
         return st
 
-    def get_tag_managers(self):
-        if not self.authorized('get_tag_managers') : return { 'st': False }
-        mgd = self.wtServer.GetTagManagers()
+    def set_account_status(self,account,auth,comm):
+        """
+        Authorized and Comm are only true when they are for every account.
+        """
+        self.account_status[account] = (auth,comm)
+        self.set_auth(all(st[0] for st in self.account_status.values()))
+        self.set_comm(all(st[1] for st in self.account_status.values()))
+
+    def get_tag_managers(self,account='default'):
+        server = self.get_server(account)
+        if server.oauth2_code == False:
+            self.l_error('get_tag_managers',"Account {0} is not authorized".format(account))
+            return { 'st': False }
+        mgd = server.GetTagManagers()
         self.set_comm(mgd['st'])
         return mgd
 
@@ -304,12 +541,6 @@ class wtController(polyinterface.Controller):
             self.server_time = mgd['result']
         return mgd
 
-    def load_temp_sensor_config(self,tag_id):
-        if not self.authorized('load_temp_sensor_config') : return { 'st': False }
-        mgd = self.wtServer.LoadTempSensorConfig({'id': tag_id})
-        self.set_comm(mgd['st'])
-        return mgd
-
     def get_node(self,address):
         """
         Returns a node that already exists in the controller.
@@ -322,7 +553,136 @@ class wtController(polyinterface.Controller):
                 return self.nodes[node]
         return None
 
+    def save_token(self,token):
+        self.l_info('save_token','expires={0}'.format(time.ctime(token['expires'])))
+        self.set_custom_data('token',token)
+
+    """
+     Accounts, the default one uses oauth2_code and has the REST server,
+     the others are listed in the accounts param and share it.
+    """
+    def start_accounts(self):
+        tokens = self.get_custom_data('tokens',dict())
+        for account in self.accounts:
+            self.l_info('start_accounts','Starting account {0}'.format(account))
+            server = wtServer(LOGGER,self.client_id,self.client_secret,partial(self.account_get_handler,account),
+                              self.account_codes[account],rest=self.wtServer.rest,account=account,
+                              token=tokens.get(account),token_handler=partial(self.save_account_token,account),
+                              cache_ttl=self.get_float_param('cache_ttl',5))
+            server.start()
+            self.wtServer.peers[account] = server
+            self.servers[account] = server
+
+    def get_server(self,account):
+        return self.servers.get(account,self.wtServer)
+
+    def account_get_handler(self,account,command,params):
+        # The accounts only get the /code, events all go to get_handler.
+        if command == '/code':
+            return self.set_account_oauth2(account,params['oauth2_code'])
+        self.l_error('account_get_handler','{0} unexpected command {1}'.format(account,command))
+        return False
+
+    def set_account_oauth2(self,account,value):
+        if self.account_codes.get(account) != value:
+            self.account_codes[account] = value
+            self.save_params()
+            self.tasks.submit('discover',self.discover_account,args=(account,),key=('discover',account),
+                              callback=self.task_done)
+        return True
+
+    def save_account_token(self,account,token):
+        self.l_info('save_account_token','{0} expires={1}'.format(account,time.ctime(token['expires'])))
+        tokens = dict(self.get_custom_data('tokens',dict()))
+        tokens[account] = token
+        self.set_custom_data('tokens',tokens)
+
+    def get_manager_account(self,mac):
+        return self.get_custom_data('manager_accounts',dict()).get(mac,'default')
+
+    def set_manager_account(self,mac,account):
+        if self.get_manager_account(mac) == account: return
+        accounts = dict(self.get_custom_data('manager_accounts',dict()))
+        accounts[mac] = account
+        self.set_custom_data('manager_accounts',accounts)
+
+    def get_listen_port(self):
+        """
+        Use the configured port, otherwise the one we had last time so the
+        URL's saved in the tags are still valid.
+        """
+        if self.listen_port_param > 0:
+            return self.listen_port_param
+        return self.get_custom_data('listen_port',0)
+
+    def get_float_param(self,name,default):
+        try:
+            return float(self.polyConfig['customParams'].get(name,default))
+        except ValueError:
+            self.l_error('get_float_param',"{0} must be a number, not {1}".format(name,self.polyConfig['customParams'][name]))
+            return default
+
     def load_params(self):
+        # 0 means reuse the last port.
+        try:
+            self.listen_port_param = int(self.polyConfig['customParams'].get('listen_port',0))
+        except ValueError:
+            self.l_error('load_params',"listen_port must be a number, not {0}".format(self.polyConfig['customParams']['listen_port']))
+            self.listen_port_param = 0
+        # GET sends each event as a query string, POST as a JSON body.
+        self.event_mode = str(self.polyConfig['customParams'].get('event_mode','GET')).upper()
+        if not self.event_mode in ('GET','POST'):
+            self.l_error('load_params',"event_mode must be GET or POST, not {0}".format(self.event_mode))
+            self.event_mode = 'GET'
+        # Seconds to collect tag queries, and the minimum seconds between forced postbacks of a tag.
+        self.query_window      = self.get_float_param('query_window',1.0)
+        self.postback_interval = self.get_float_param('postback_interval',0)
+        # Run the REST server in it's own process?
+        self.rest_process = self.polyConfig['customParams'].get('rest_process','false').lower() == 'true'
+        # More accounts, comma seperated, each with an oauth2_code_<name> param.
+        self.accounts = list()
+        for account in self.polyConfig['customParams'].get('accounts','').split(','):
+            account = account.strip()
+            if account != '' and account != 'default' and not account in self.accounts:
+                self.accounts.append(account)
+        self.account_codes = dict()
+        for account in self.accounts:
+            code = self.polyConfig['customParams'].get('oauth2_code_'+account,'')
+            self.account_codes[account] = False if code in ('','False','false') else code
+        # Tag Managers we can call directly, mac=url comma seperated
+        self.lan_urls = dict()
+        for item in self.polyConfig['customParams'].get('lan_urls','').split(','):
+            if item.strip() == '': continue
+            mac, sep, url = item.partition('=')
+            if sep == '' or url.strip() == '':
+                self.l_error('load_params',"lan_urls entries must be mac=url, not {0}".format(item))
+                continue
+            self.lan_urls[mac.strip().upper()] = url.strip()
+        # Seconds to collapse bursts of each motion/door event, event=seconds comma seperated
+        self.collapse_events = dict()
+        for item in self.polyConfig['customParams'].get('collapse_events',
+                'motion_detected=1,motion_timedout=1,door_opened=1,door_closed=1,door_open_toolong=0').split(','):
+            if item.strip() == '': continue
+            event, sep, window = item.partition('=')
+            event = event.strip()
+            if (wTag.event_setters.get('/'+event) or (None,))[0] != 'set_motion':
+                self.l_error('load_params',"collapse_events only works for motion and door events, not {0}".format(item))
+                continue
+            try:
+                self.collapse_events[event] = max(float(window),0)
+            except ValueError:
+                self.l_error('load_params',"collapse_events entries must be event=seconds, not {0}".format(item))
+        # wTag.get_handler looks them up by command
+        self.collapse_windows = dict(('/'+event, window) for event, window in self.collapse_events.items())
+        # Add the dewpoint, average, slope and daily min/max drivers to the tags?
+        self.derived_metrics = self.polyConfig['customParams'].get('derived_metrics','false').lower() == 'true'
+        self.trace_events = self.polyConfig['customParams'].get('trace_events','false').lower() == 'true'
+        # Days remaining when the battery forecast says it's low.
+        self.battery_low_days = self.get_float_param('battery_low_days',30)
+        # SQLite file for the history, empty to disable it.
+        self.db_file = str(self.polyConfig['customParams'].get('db_file','')).strip()
+        # Where to send line protocol points, empty to disable it.
+        self.export_url = str(self.polyConfig['customParams'].get('export_url','')).strip()
         if 'oauth2_code' in self.polyConfig['customParams']:
             self.set_oauth2(self.polyConfig['customParams']['oauth2_code'],save=False)
         else:
@@ -332,13 +692,46 @@ class wtController(polyinterface.Controller):
 
     def save_params(self):
         # Make sure latest code is in the params
-        self.addCustomParam({'oauth2_code': self.oauth2_code})
+        params = {
+            'oauth2_code':       self.oauth2_code,
+            'listen_port':       self.listen_port_param,
+            'event_mode':        self.event_mode,
+            'rest_process':      str(self.rest_process).lower(),
+            'query_window':      self.query_window,
+            'postback_interval': self.postback_interval,
+            'cache_ttl':         self.get_float_param('cache_ttl',5),
+            'task_workers':      int(self.get_float_param('task_workers',4)),
+            'db_file':           self.db_file,
+            'db_days':           self.get_float_param('db_days',7),
+            'derived_metrics':   str(self.derived_metrics).lower(),
+            'metrics_avg_minutes':   self.get_float_param('metrics_avg_minutes',30),
+            'metrics_slope_minutes': self.get_float_param('metrics_slope_minutes',60),
+            'battery_low_days':  self.battery_low_days,
+            'export_url':        self.export_url,
+            'export_batch':      int(self.get_float_param('export_batch',500)),
+            'export_interval':   self.get_float_param('export_interval',10),
+            'accounts':          ','.join(self.accounts),
+            'add_rate':          self.get_float_param('add_rate',10),
+            'add_batch':         int(self.get_float_param('add_batch',10)),
+            'add_timeout':       self.get_float_param('add_timeout',60),
+            'publish_low_rate':  self.get_float_param('publish_low_rate',20),
+            'trace_events':      str(self.trace_events).lower(),
+            'rest_watchdog':     self.get_float_param('rest_watchdog',0.5),
+            'lan_urls':          ','.join('{0}={1}'.format(mac,url) for mac, url in self.lan_urls.items()),
+            'collapse_events':   ','.join('{0}={1}'.format(event,window) for event, window in self.collapse_events.items()),
+        }
+        for account in self.accounts:
+            params['oauth2_code_'+account] = self.account_codes[account]
+        self.addCustomParam(params)
         self.removeNoticesAll()
         if self.oauth2_code == False:
             if hasattr(self,'wtServer'):
                 self.addNotice('Click <a target="_blank" href="{0}&redirect_uri={1}/code">Authorize</a> to link your CAO Wireless Sensor Tags account'.format(self.auth_url,self.wtServer.url))
             else:
                 self.addNotice("No Athorization, and no REST Server running, this should not be possible!")
+        for account in self.accounts:
+            if self.account_codes[account] == False and hasattr(self,'wtServer'):
+                self.addNotice('Click <a target="_blank" href="{0}&redirect_uri={1}/code&state={2}">Authorize</a> to link your {2} CAO Wireless Sensor Tags account'.format(self.auth_url,self.wtServer.url,account))
 
     def set_url_config(self):
         # TODO: Should loop over tag managers, and call set_url_config on the tag manager
@@ -461,6 +854,19 @@ class wtController(polyinterface.Controller):
         self.l_info("cmd_install_profile","installing...")
         self.poly.installprofile()
 
+    def cmd_profile_start(self,command):
+        val = command.get('value')
+        # Keep the window bounded, default to 1 minute.
+        if val is None or int(val) <= 0:
+            val = 60
+        val = min(int(val),3600)
+        self.l_info("cmd_profile_start",val)
+        self.profiler.start(val)
+
+    def cmd_profile_stop(self,command):
+        self.l_info("cmd_profile_stop","stopping...")
+        self.profiler.stop()
+
     """
     Node Definitions
     """
@@ -471,7 +877,9 @@ class wtController(polyinterface.Controller):
         'SET_LONGPOLL':  cmd_set_long_poll,
         'QUERY': query,
         'DISCOVER': discover,
-        'INSTALL_PROFILE': cmd_install_profile
+        'INSTALL_PROFILE': cmd_install_profile,
+        'PROFILE_START': cmd_profile_start,
+        'PROFILE_STOP': cmd_profile_stop
     }
     drivers = [
         {'driver': 'ST',  'value': 0, 'uom': 2},
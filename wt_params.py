@@ -86,3 +86,64 @@ wt_params = {
     # {0}: Tag name, {1}: Tag ID, {2}: timestamp
     'water_dried': 'hum={1}&ts={2}',
  }
+
+"""
+The fields for each event in template order, {0} is the first one.  These are
+used to build the JSON body when events are POST'ed so nothing is lost to the
+url encoding, see wt_json_safe for the ones that are.
+"""
+wt_fields = {
+    'update':            ('name', 'tagid', 'temp', 'hum', 'lux', 'ts'),
+    'oor':               ('name', 'last', 'tagid', 'ts'),
+    'back_in_range':     ('name', 'last', 'tagid', 'ts'),
+    'motion_detected':   ('name', 'orien', 'xaxis', 'yaxis', 'zaxis', 'tagid', 'ts'),
+    'motion_timedout':   ('name', 'ts', 'tagid'),
+    'door_opened':       ('name', 'orien', 'xaxis', 'yaxis', 'zaxis', 'tagid', 'ts'),
+    'door_closed':       ('name', 'orien', 'xaxis', 'yaxis', 'zaxis', 'tagid', 'ts'),
+    'door_open_toolong': ('name', 'ochg', 'hlong', 'tagid'),
+    'temp_toohigh':      ('name', 'tempf', 'tempc', 'tagid', 'ts'),
+    'temp_toolow':       ('name', 'tempf', 'tempc', 'tagid', 'ts'),
+    'temp_normal':       ('name', 'tempf', 'tempc', 'tagid', 'ts'),
+    'too_bright':        ('name', 'tagid', 'lux', 'ts'),
+    'too_dark':          ('name', 'tagid', 'lux', 'ts'),
+    'light_normal':      ('name', 'tagid', 'lux', 'ts'),
+    'low_battery':       ('name', 'volt', 'thrs', 'tagid', 'ts'),
+    'too_humid':         ('name', 'hum', 'tagid', 'ts'),
+    'too_dry':           ('name', 'hum', 'tagid', 'ts'),
+    'cap_normal':        ('name', 'hum', 'tagid', 'ts'),
+    'water_detected':    ('name', 'tagid', 'ts'),
+    'water_dried':       ('name', 'tagid', 'ts'),
+}
+
+# The type of each field, anything not listed is left as a string.
+wt_types = {
+    'tagid': int,
+    'temp':  float,
+    'hum':   float,
+    'lux':   float,
+    'orien': float,
+    'xaxis': float,
+    'yaxis': float,
+    'zaxis': float,
+    'ochg':  float,
+    'tempf': float,
+    'tempc': float,
+    'volt':  float,
+    'thrs':  float,
+}
+
+# Fields the cloud fills in that can't have a quote or backslash in them.
+wt_json_safe = set(wt_types) | {'ts'}
+
+def wt_json_template(key,mac):
+    """
+    The JSON body template for event key, values are all quoted since the
+    cloud leaves them empty when a tag doesn't have them, they are converted
+    by wt_types.  The cloud doesn't escape what it fills in, so text fields
+    like the tag name are left out, a quote in one would break the JSON.
+    """
+    parts = ['"event":"{0}"'.format(key), '"tmgr_mac":"{0}"'.format(mac)]
+    for i, field in enumerate(wt_fields[key]):
+        if field in wt_json_safe:
+            parts.append('"{0}":"{{{1}}}"'.format(field,i))
+    return '{' + ','.join(parts) + '}'
@@ -0,0 +1,136 @@
+"""
+On demand profiling for the running node server.
+
+cProfile only hooks the thread that enables it, and the work we care about
+happens in the REST listener, the Polyglot input thread and the discover
+threads, so this samples the stacks of every thread instead. Memory is
+tracked with tracemalloc snapshots taken at the start and end of the window.
+"""
+import os,sys,time,threading,tracemalloc
+from collections import Counter
+
+class wtProfiler():
+
+    def __init__(self,logger,path='.',interval=0.01,top=20):
+        self.logger   = logger
+        self.path     = path
+        self.interval = interval
+        self.top      = top
+        self.running  = False
+        self.lock     = threading.Lock()
+        self.thread   = None
+        self.timer    = None
+
+    def start(self,duration=60):
+        """
+        Start sampling for duration seconds, it is stopped automatically
+        when the window ends.
+        """
+        with self.lock:
+            if self.running:
+                self.l_error('start','Already running, stop it first')
+                return False
+            self.running   = True
+            self.duration  = int(duration)
+            self.stime     = time.time()
+            self.samples   = 0
+            self.self_cnt  = Counter()
+            self.cum_cnt   = Counter()
+            self.mem_start = None
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self.stop_tracing = True
+            else:
+                self.stop_tracing = False
+            self.mem_start = tracemalloc.take_snapshot()
+            self.thread = threading.Thread(target=self._sample,name='wtProfiler')
+            self.thread.daemon = True
+            self.thread.start()
+            self.timer = threading.Timer(self.duration,self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+        self.l_info('start','Profiling for {0} seconds'.format(self.duration))
+        return True
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                self.l_info('stop','Not running')
+                return False
+            self.running = False
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        self.thread.join()
+        mem_end = tracemalloc.take_snapshot()
+        if self.stop_tracing:
+            tracemalloc.stop()
+        elapsed = time.time() - self.stime
+        stamp   = time.strftime('%Y%m%d-%H%M%S',time.localtime(self.stime))
+        self.write_cpu(os.path.join(self.path,'profile-{0}.txt'.format(stamp)),elapsed)
+        self.write_mem(os.path.join(self.path,'tracemalloc-{0}.txt'.format(stamp)),mem_end)
+        return True
+
+    def _sample(self):
+        me = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                seen = set()
+                key  = self.frame_key(frame)
+                self.self_cnt[key] += 1
+                while frame is not None:
+                    key = self.frame_key(frame)
+                    # Recursion should only count once per sample.
+                    if key not in seen:
+                        self.cum_cnt[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def frame_key(self,frame):
+        code = frame.f_code
+        return '{0}:{1}({2})'.format(code.co_filename,code.co_firstlineno,code.co_name)
+
+    def write_cpu(self,fname,elapsed):
+        lines = [
+            'Sampled {0} times in {1:.1f} seconds, interval={2}'.format(self.samples,elapsed,self.interval),
+            '',
+            'Top self:',
+        ]
+        for key, cnt in self.self_cnt.most_common(self.top):
+            lines.append('{0:8d} {1:6.2f}% {2}'.format(cnt,self.pct(cnt),key))
+        lines.append('')
+        lines.append('Top cumulative:')
+        for key, cnt in self.cum_cnt.most_common(self.top):
+            lines.append('{0:8d} {1:6.2f}% {2}'.format(cnt,self.pct(cnt),key))
+        self.write_file(fname,lines,self.self_cnt.most_common()[self.top:])
+
+    def write_mem(self,fname,mem_end):
+        stats = mem_end.compare_to(self.mem_start,'lineno')
+        lines = ['Top allocation growth:']
+        for stat in stats[:self.top]:
+            lines.append(str(stat))
+        self.write_file(fname,lines,stats[self.top:])
+
+    def write_file(self,fname,lines,rest):
+        self.l_info('write_file','{0}:\n{1}'.format(fname,'\n'.join(lines)))
+        try:
+            with open(fname,'w') as f:
+                f.write('\n'.join(lines))
+                f.write('\n\nRemaining:\n')
+                for item in rest:
+                    f.write('{0}\n'.format(item))
+        except Exception as err:
+            self.l_error('write_file','failed to write {0}: {1}'.format(fname,err))
+
+    def pct(self,cnt):
+        if self.samples == 0: return 0.0
+        return cnt * 100.0 / self.samples
+
+    def l_info(self, name, string):
+        self.logger.info("wtProfiler:%s: %s" %  (name,string))
+
+    def l_error(self, name, string):
+        self.logger.error("wtProfiler:%s: %s" % (name,string))
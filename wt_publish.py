@@ -0,0 +1,125 @@
+"""
+Queue for the driver updates sent to Polyglot.
+
+Updates are sent by one thread, highest priority class first, so a motion
+or water alarm never waits behind a full refresh of every tag.  Alarms are
+sent in order, every one of them, when the value changed, a refresh of one
+that didn't is sent as normal.  Normal and low updates to a driver that is
+already waiting just replace the value, and low ones are limited to
+low_rate a second.
+"""
+import time,threading
+from collections import deque,OrderedDict
+
+PRIORITY_ALARM  = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW    = 2
+
+PRIORITY_NAMES = { PRIORITY_ALARM: 'alarm', PRIORITY_NORMAL: 'normal', PRIORITY_LOW: 'low' }
+
+# Drivers that aren't here are normal.
+DRIVER_PRIORITY = {
+    'GV2':   PRIORITY_ALARM,   # Motion
+    'ALARM': PRIORITY_ALARM,   # Event State
+    'GV12':  PRIORITY_ALARM,   # Water State
+    'GV8':   PRIORITY_ALARM,   # Out Of Range
+    'GV14':  PRIORITY_LOW,     # Seconds since update
+    'GV13':  PRIORITY_LOW,     # Time
+    'BATLVL':PRIORITY_LOW,
+    'CV':    PRIORITY_LOW,
+    'CC':    PRIORITY_LOW,     # signaldBm
+    'GV20':  PRIORITY_LOW,     # Battery days
+}
+
+class wtPublisher():
+
+    def __init__(self,logger,send,low_rate=20):
+        self.logger   = logger
+        self.send     = send
+        self.low_rate = float(low_rate)
+        self.cond     = threading.Condition()
+        # Alarms are a fifo, the others are by (address,driver) so they coalesce.
+        self.queues   = {
+            PRIORITY_ALARM:  deque(),
+            PRIORITY_NORMAL: OrderedDict(),
+            PRIORITY_LOW:    OrderedDict(),
+        }
+        # Always room for one, or a rate under 1 would never send any.
+        self.max_tokens = max(1.0,self.low_rate)
+        self.tokens   = self.max_tokens
+        self.tok_time = time.time()
+        self.stats    = dict((name, { 'sent': 0, 'coalesced': 0, 'max_wait': 0.0 }) for name in PRIORITY_NAMES.values())
+        self.thread   = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._sender,name='wtPublisher')
+        self.thread.daemon = True
+        self.thread.start()
+        self.l_info('start','Publishing driver updates, low priority limited to {0}/s'.format(self.low_rate))
+
+    def publish(self,address,driver,value,uom,changed=True):
+        priority = DRIVER_PRIORITY.get(driver,PRIORITY_NORMAL)
+        if priority == PRIORITY_ALARM and not changed:
+            priority = PRIORITY_NORMAL
+        message  = { 'status': { 'address': address, 'driver': driver, 'value': str(value), 'uom': uom } }
+        key      = (address,driver)
+        with self.cond:
+            queue = self.queues[priority]
+            if priority == PRIORITY_ALARM:
+                queue.append((time.time(),message))
+                # A refresh still waiting is older than this, don't send it after.
+                self.queues[PRIORITY_NORMAL].pop(key,None)
+            else:
+                if key in queue:
+                    # Keep its place in line, and the time it got there.
+                    queue[key] = (queue[key][0],message)
+                    self.stats[PRIORITY_NAMES[priority]]['coalesced'] += 1
+                else:
+                    queue[key] = (time.time(),message)
+            self.cond.notify()
+
+    def pending(self):
+        with self.cond:
+            return dict((PRIORITY_NAMES[p], len(q)) for p, q in self.queues.items())
+
+    def get_stats(self):
+        with self.cond:
+            return dict((name, dict(st)) for name, st in self.stats.items())
+
+    def _next(self):
+        """ The next (priority,item) to send, or (None,seconds to wait) """
+        if len(self.queues[PRIORITY_ALARM]) > 0:
+            return PRIORITY_ALARM, self.queues[PRIORITY_ALARM].popleft()
+        if len(self.queues[PRIORITY_NORMAL]) > 0:
+            return PRIORITY_NORMAL, self.queues[PRIORITY_NORMAL].popitem(last=False)[1]
+        if len(self.queues[PRIORITY_LOW]) > 0:
+            now = time.time()
+            self.tokens = min(self.max_tokens,self.tokens + (now - self.tok_time) * self.low_rate)
+            self.tok_time = now
+            if self.low_rate <= 0 or self.tokens >= 1:
+                self.tokens -= 1
+                return PRIORITY_LOW, self.queues[PRIORITY_LOW].popitem(last=False)[1]
+            return None, (1 - self.tokens) / self.low_rate
+        return None, None
+
+    def _sender(self):
+        while True:
+            with self.cond:
+                priority, item = self._next()
+                while priority is None:
+                    self.cond.wait(item)
+                    priority, item = self._next()
+                qtime, message = item
+                st = self.stats[PRIORITY_NAMES[priority]]
+                st['sent'] += 1
+                st['max_wait'] = max(st['max_wait'],time.time() - qtime)
+            try:
+                self.send(message)
+            except Exception as err:
+                self.l_error('_sender','failed to send {0}: {1}'.format(message,err))
+
+    def l_info(self, name, string):
+        self.logger.info("wtPublisher:%s: %s" %  (name,string))
+
+    def l_error(self, name, string):
+        self.logger.error("wtPublisher:%s: %s" % (name,string))
@@ -0,0 +1,94 @@
+"""
+Route table for the event callbacks, built from wt_params when imported.
+
+Each event path maps to a decoder that turns the query string straight into
+the typed params for wTag.get_handler, and to the response bytes to send
+back, so handling a callback doesn't build any strings of it's own.
+"""
+from urllib.parse import unquote_plus
+from wt_params import wt_params,wt_types
+
+def get_fields(param):
+    """ The field names used in a wt_params query string """
+    return tuple(part.split('=',1)[0] for part in param.split('&'))
+
+def make_decoder(fields):
+    types = dict()
+    for name in fields + ('tmgr_mac',):
+        types[name] = wt_types.get(name,str)
+    def decode(query):
+        record = dict()
+        quoted = '%' in query or '+' in query
+        for part in query.split('&'):
+            key, sep, value = part.partition('=')
+            if quoted:
+                value = unquote_plus(value)
+            conv = types.get(key)
+            if conv is None:
+                # Not one of ours, like debug, leave it alone.
+                record[key] = value
+                continue
+            try:
+                record[key] = conv(value)
+            except ValueError:
+                # Cloud leaves fields empty when the tag doesn't have them.
+                pass
+        return record
+    return decode
+
+def make_response(path,code,protocol_version='HTTP/1.0'):
+    """ The complete http response for path and code """
+    if code == 200:
+        status, body = 'OK', 'Command {0} success\r\n'.format(path)
+    else:
+        status, body = 'Internal Server Error', 'Command {0} failed\r\n'.format(path)
+    body = body.encode('utf-8')
+    head = '{0} {1} {2}\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Length: {3}\r\n\r\n'.format(
+        protocol_version,code,status,len(body))
+    return head.encode('latin-1') + body
+
+def make_routes(protocol_version='HTTP/1.0'):
+    """
+    Returns { path: (decoder, { True: ok response, False: failed response }) }
+    """
+    routes = dict()
+    for key, param in wt_params.items():
+        path = '/' + key
+        routes[path] = (
+            make_decoder(get_fields(param)),
+            { True: make_response(path,200,protocol_version), False: make_response(path,500,protocol_version) }
+        )
+    return routes
+
+wt_routes = make_routes()
+
+if __name__ == '__main__':
+    # Micro benchmark of the old parse vs the route decoders.
+    import time
+    from urllib import parse
+    from urllib.parse import parse_qsl
+    path = '/motion_detected?tmgr_mac=0E994A04A300&tagid=3&orien=12.5&xaxis=-3&yaxis=12&zaxis=64&ts=2018-03-04T20:46:18+00:00'
+    count = 100000
+
+    def old(path):
+        parsed_path = parse.urlparse(path)
+        query = dict(parse_qsl(parsed_path.query))
+        message_parts = ["Received: {0} {1}. ".format(parsed_path.path,query)]
+        message_parts.append("Code: {0}".format(200))
+        message_parts.append('Command {0} success'.format(parsed_path.path))
+        message_parts.append('')
+        message = '\r\n'.join(message_parts) + '\r\n'
+        return int(query['tagid']), float(query['orien']), message.encode('utf-8')
+
+    def new(path):
+        rpath, sep, query = path.partition('?')
+        decode, responses = wt_routes[rpath]
+        params = decode(query)
+        return params['tagid'], params['orien'], responses[True]
+
+    for name, func in (('parse_qsl',old),('wt_routes',new)):
+        stime = time.perf_counter()
+        for i in range(count):
+            func(path)
+        elapsed = time.perf_counter() - stime
+        print('{0:10s} {1:10.0f} requests/second'.format(name,count/elapsed))
@@ -0,0 +1,177 @@
+"""
+The tag types and their drivers, the tag nodedefs and NLS names in the
+profile and the wTag driver list are all made from these.
+
+After changing them run
+  python3 wt_schema.py
+to update the profile, check_profile also does this at startup.
+"""
+import os
+
+# (driver, uom, default value, editor, comment)
+#   uom and editor of 'temp' are the temperature ones for C or F
+#   editor None is not shown in the nodedef
+DRIVERS = (
+    ('ST',      2,      0,  'BOOL',        'Status, online?'),
+    ('GPV',     56,     0,  'I_TAGID',     'TagId (SlaveId)'),
+    ('UOM',     56,     0,  None,          '0=C 1=F'),
+    ('GV1',     56,     0,  'I_TAGTYPE',   'TagType'),
+    ('GV13',    25,     0,  'I_INTEGER',   'Time'),
+    ('GV14',    25,     0,  'I_INTEGER',   'Seconds since update'),
+    ('GV20',    10,     -1, 'I_DAYS',      'Battery Days Remaining'),
+    ('GV21',    25,     0,  'I_BATLOW',    'Battery Low'),
+    ('GV8',     2,      0,  'BOOL',        'Out Of Range'),
+    ('CC',      56,     0,  'SIGDBM',      'signaldBm'),
+    ('ALARM',   25,     0,  'I_EVST',      'Event State'),
+    ('GV7',     25,     0,  'I_LIT',       'Light'),
+    ('CLITEMP', 'temp', 0,  'temp',        'Temperature'),
+    ('CLIHUM',  22,     0,  'I_HUM',       'Humidity'),
+    ('LUMIN',   36,     0,  'LUMIN',       'Lux'),
+    ('BATLVL',  51,     0,  'BATLVL',      'Battery Percentage'),
+    ('CV',      72,     0,  'FLOAT',       'Battery Voltage'),
+    ('GV2',     25,     0,  'I_MOTION',    'Motion'),
+    ('GV3',     56,     0,  'FLOAT',       'Orientation'),
+    ('GV4',     56,     0,  'FLOAT',       'X-Axis'),
+    ('GV5',     56,     0,  'FLOAT',       'Y-Axis'),
+    ('GV6',     56,     0,  'FLOAT',       'Z-Axis'),
+    ('GV9',     25,     0,  'I_TMST',      'Temperature State'),
+    ('GV10',    25,     0,  'I_CPST',      'Moisture State'),
+    ('GV11',    25,     0,  'I_LIST',      'Light State'),
+    ('GV12',    25,     1,  'I_WTST',      'Water State'),
+    ('GV15',    'temp', 0,  'temp',        'Dewpoint'),
+    ('GV16',    'temp', 0,  'temp',        'Average Temperature'),
+    ('GV17',    56,     0,  'I_TEMP_RATE', 'Temperature Change per Hour'),
+    ('GV18',    'temp', 0,  'temp',        'Daily Minimum Temperature'),
+    ('GV19',    'temp', 0,  'temp',        'Daily Maximum Temperature'),
+)
+
+# Every tag has these
+BASE      = ('ST','GPV','UOM','GV1','GV13','GV14','GV20','GV21','GV7','CLITEMP','BATLVL','CV','GV9')
+MOTION    = ('GV2','GV3','GV4','GV5','GV6')
+SIGNAL    = ('GV8','CC')
+# Only added when derived_metrics is on, GV15 needs CLIHUM
+METRICS   = ('GV15','GV16','GV17','GV18','GV19')
+
+# http://wirelesstag.net/kumoapp/17/tags-kumosensors-kumostats
+TAG_TYPES = {
+    12: { 'name': 'Motion Sensor Tag (8-bit temperature)',
+          'drivers': BASE + ('ALARM',) + MOTION + SIGNAL },
+    13: { 'name': 'Motion Sensor Tag (13-bit temperature+humidity)',
+          'drivers': BASE + ('ALARM','CLIHUM','GV10') + MOTION + SIGNAL },
+    21: { 'name': 'Motion Sensor Tag Pro',
+          'drivers': BASE + ('ALARM','CLIHUM','GV10') + MOTION + SIGNAL },
+    26: { 'name': 'Motion Sensor Tag Pro ALS (Ambient Light Sensor)',
+          'drivers': BASE + ('ALARM','CLIHUM','GV10','LUMIN','GV11') + SIGNAL },
+    32: { 'name': 'Water/Soil moisture sensor',
+          'drivers': BASE + ('ALARM','CLIHUM','GV10','GV12') + SIGNAL },
+    42: { 'name': 'Outdoor Probe/Thermocouple',
+          'drivers': BASE },
+    52: { 'name': 'Door/window (reed) KumoSensor',
+          'drivers': BASE + ('ALARM','CLIHUM','GV10') + SIGNAL },
+    62: { 'name': 'Kumostat/Nest Thremostat', 'light': False,
+          'drivers': BASE + ('ALARM','CLIHUM','GV10') },
+    72: { 'name': 'Infra-Red (PIR) KumoSensor',
+          'drivers': BASE + ('ALARM','CLIHUM','GV10') + SIGNAL },
+    82: { 'name': 'WeMo Switches/Maker/LED', 'light': False, 'metrics': False,
+          'drivers': BASE },
+    92: { 'name': 'Webcams (Dropcam)', 'light': False, 'metrics': False,
+          'drivers': BASE },
+}
+
+def has_metrics(tag_type):
+    return TAG_TYPES.get(tag_type,{}).get('metrics',True)
+
+def get_type_drivers(tag_type,metrics=True):
+    """ Driver names for tag_type in DRIVERS order """
+    tdef  = TAG_TYPES.get(tag_type)
+    names = set(BASE if tdef is None else tdef['drivers'])
+    if metrics and has_metrics(tag_type):
+        names.update(METRICS)
+        if not 'CLIHUM' in names:
+            names.discard('GV15')
+    return [d for d in DRIVERS if d[0] in names]
+
+def get_tag_drivers(tag_type,tag_uom,metrics=False):
+    """ The drivers list for a wTag, tag_uom 0=C 1=F """
+    temp_uom = 4 if tag_uom == 0 else 17
+    return [{ 'driver': d[0], 'value': d[2], 'uom': temp_uom if d[1] == 'temp' else d[1] }
+            for d in get_type_drivers(tag_type,metrics)]
+
+def make_nodedef(tag_type,uomS):
+    tdef = TAG_TYPES[tag_type]
+    lines = [
+        '  <!-- Tag {0} {1} -->'.format(tag_type,uomS),
+        '  <nodeDef id="wTag{0}{1}" nls="tag{0}">'.format(tag_type,uomS),
+        '    <editors />',
+        '    <sts>',
+    ]
+    for driver, uom, value, editor, comment in get_type_drivers(tag_type):
+        if editor is None: continue
+        if editor == 'temp':
+            editor = 'I_TEMP_' + uomS
+        lines.append('      <st id="{0}" editor="{1}" /> <!-- {2} -->'.format(driver,editor,comment))
+    lines += [
+        '    </sts>',
+        '    <cmds>',
+        '      <sends />',
+        '      <accepts>',
+    ]
+    if tdef.get('light',True):
+        lines += [
+            '        <cmd id="SET_LIGHT">',
+            '          <p id="" editor="I_LIT" init="GV7" />',
+            '        </cmd>',
+        ]
+    lines += [
+        '        <cmd id="QUERY" />',
+        '      </accepts>',
+        '    </cmds>',
+        '  </nodeDef>',
+        '',
+    ]
+    return lines
+
+def make_nodedefs():
+    lines = list()
+    for tag_type in sorted(TAG_TYPES):
+        for uomS in ('F','C'):
+            lines += make_nodedef(tag_type,uomS)
+    return lines
+
+def make_nls():
+    lines = list()
+    for uomS in ('F','C'):
+        for tag_type in sorted(TAG_TYPES):
+            lines.append('ND-wTag{0}{1}-NAME = {2} ({0}) ({1})'.format(tag_type,uomS,TAG_TYPES[tag_type]['name']))
+        lines.append('')
+    return lines[:-1]
+
+# Files with a generated section, and the lines it's between.
+GENERATED = (
+    ('profile/nodedef/nodedefs.xml', make_nodedefs, '  <!-- BEGIN generated by wt_schema.py -->', '  <!-- END generated by wt_schema.py -->'),
+    ('profile/nls/en_us.txt',        make_nls,      '# BEGIN generated by wt_schema.py',          '# END generated by wt_schema.py'),
+)
+
+def make_profile(path='.'):
+    """ Update the generated parts of the profile, returns the files that changed """
+    changed = list()
+    for fname, func, begin, end in GENERATED:
+        fname = os.path.join(path,fname)
+        with open(fname) as f:
+            text = f.read()
+        head, sep, rest = text.partition(begin + '\n')
+        if sep == '':
+            raise ValueError('{0} is missing {1}'.format(fname,begin))
+        body, sep, tail = rest.partition(end + '\n')
+        if sep == '':
+            raise ValueError('{0} is missing {1}'.format(fname,end))
+        new = head + begin + '\n' + '\n'.join(func()) + '\n' + end + '\n' + tail
+        if new != text:
+            with open(fname,'w') as f:
+                f.write(new)
+            changed.append(fname)
+    return changed
+
+if __name__ == '__main__':
+    for fname in make_profile():
+        print('Updated {0}'.format(fname))
@@ -0,0 +1,158 @@
+"""
+Local history of the tag readings and events in SQLite.
+
+Readings are queued and written in batches by a background thread so the
+event path never waits on the disk.  1 minute and 1 hour min/max/avg rollups
+are updated as each batch is written, and old rows are deleted hourly.
+"""
+import time,threading,queue,sqlite3
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS readings (ts INTEGER, address TEXT, driver TEXT, value REAL)',
+    'CREATE INDEX IF NOT EXISTS readings_ts ON readings (ts)',
+    'CREATE INDEX IF NOT EXISTS readings_address ON readings (address, driver, ts)',
+    'CREATE TABLE IF NOT EXISTS events (ts INTEGER, address TEXT, event TEXT)',
+    'CREATE INDEX IF NOT EXISTS events_ts ON events (ts)',
+    'CREATE TABLE IF NOT EXISTS rollup_1m (bucket INTEGER, address TEXT, driver TEXT, min REAL, max REAL, sum REAL, cnt INTEGER, PRIMARY KEY (bucket, address, driver))',
+    'CREATE TABLE IF NOT EXISTS rollup_1h (bucket INTEGER, address TEXT, driver TEXT, min REAL, max REAL, sum REAL, cnt INTEGER, PRIMARY KEY (bucket, address, driver))',
+)
+
+# Rollup table and it's bucket size in seconds
+ROLLUPS = (('rollup_1m',60), ('rollup_1h',3600))
+
+class wtStore():
+
+    def __init__(self,logger,fname,raw_days=7,rollup_1m_days=30,rollup_1h_days=730,
+                 batch_size=500,flush_interval=5,max_queue=10000):
+        self.logger         = logger
+        self.fname          = fname
+        # Days to keep each table
+        self.retention      = {
+            'readings':  raw_days,
+            'events':    raw_days,
+            'rollup_1m': rollup_1m_days,
+            'rollup_1h': rollup_1h_days,
+        }
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.queue          = queue.Queue(max_queue)
+        self.stats          = { 'written': 0, 'dropped': 0, 'batches': 0 }
+        self.thread         = None
+
+    def start(self):
+        try:
+            db = self.connect()
+            for sql in SCHEMA:
+                db.execute(sql)
+            db.commit()
+            db.close()
+        except sqlite3.Error as err:
+            self.l_error('start','failed to open {0}: {1}'.format(self.fname,err))
+            return False
+        self.thread = threading.Thread(target=self._writer,name='wtStore')
+        self.thread.daemon = True
+        self.thread.start()
+        self.l_info('start','Saving history in {0} retention={1}'.format(self.fname,self.retention))
+        return True
+
+    def connect(self):
+        db = sqlite3.connect(self.fname)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def add_reading(self,address,driver,value,ts=None):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return False
+        return self._put(('r',int(ts or time.time()),address,driver,value))
+
+    def add_event(self,address,event,ts=None):
+        return self._put(('e',int(ts or time.time()),address,event))
+
+    def _put(self,item):
+        # Never wait, if the writer is that far behind drop it.
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.stats['dropped'] += 1
+            return False
+        return True
+
+    def _writer(self):
+        db = self.connect()
+        next_purge = 0
+        while True:
+            batch = list()
+            etime = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = etime - time.time()
+                if timeout <= 0: break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                if len(batch) > 0:
+                    self.write(db,batch)
+                if time.time() > next_purge:
+                    self.purge(db)
+                    next_purge = time.time() + 3600
+            except sqlite3.Error as err:
+                self.l_error('_writer','failed to write {0} entries: {1}'.format(len(batch),err))
+                self.stats['dropped'] += len(batch)
+                db.rollback()
+
+    def write(self,db,batch):
+        readings = [item[1:] for item in batch if item[0] == 'r']
+        events   = [item[1:] for item in batch if item[0] == 'e']
+        # Combine the batch per bucket before touching the rollup tables.
+        rollups = dict()
+        for table, size in ROLLUPS:
+            rollup = dict()
+            for ts, address, driver, value in readings:
+                key = (ts - ts % size,address,driver)
+                cur = rollup.get(key)
+                if cur is None:
+                    rollup[key] = [value,value,value,1]
+                else:
+                    cur[0] = min(cur[0],value)
+                    cur[1] = max(cur[1],value)
+                    cur[2] += value
+                    cur[3] += 1
+            rollups[table] = rollup
+        with db:
+            db.executemany('INSERT INTO readings VALUES (?,?,?,?)',readings)
+            db.executemany('INSERT INTO events VALUES (?,?,?)',events)
+            for table, rollup in rollups.items():
+                # Old SQLite on Stretch doesn't have upsert.
+                db.executemany('INSERT OR IGNORE INTO {0} VALUES (?,?,?,NULL,NULL,0,0)'.format(table),
+                               list(rollup.keys()))
+                db.executemany(('UPDATE {0} SET min=min(coalesce(min,?),?), max=max(coalesce(max,?),?), sum=sum+?, cnt=cnt+?'
+                                ' WHERE bucket=? AND address=? AND driver=?').format(table),
+                               [(v[0],v[0],v[1],v[1],v[2],v[3]) + k for k, v in rollup.items()])
+        self.stats['written'] += len(batch)
+        self.stats['batches'] += 1
+
+    def purge(self,db):
+        now = time.time()
+        with db:
+            for table, days in self.retention.items():
+                col = 'ts' if table in ('readings','events') else 'bucket'
+                db.execute('DELETE FROM {0} WHERE {1} < ?'.format(table,col),(int(now - days * 86400),))
+
+    def get_rollup(self,address,driver,table='rollup_1h',since=0):
+        """ [(bucket, min, max, avg)] for the address and driver """
+        db = self.connect()
+        try:
+            return db.execute(('SELECT bucket, min, max, sum/cnt FROM {0} WHERE address=? AND driver=? AND bucket>=?'
+                               ' ORDER BY bucket').format(table),(address,driver,since)).fetchall()
+        finally:
+            db.close()
+
+    def l_info(self, name, string):
+        self.logger.info("wtStore:%s: %s" %  (name,string))
+
+    def l_error(self, name, string):
+        self.logger.error("wtStore:%s: %s" % (name,string))
@@ -0,0 +1,158 @@
+"""
+Shared worker threads for the long running jobs, like discover and
+set_url_config, so they don't each start their own thread.
+"""
+import time,threading,itertools,queue
+from collections import deque
+
+PRIORITY_HIGH   = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW    = 9
+
+class wtTask():
+
+    def __init__(self,name,target,args,kwargs,key,priority,callback,serial=None):
+        self.name      = name
+        self.target    = target
+        self.args      = args
+        self.kwargs    = kwargs
+        self.key       = key
+        self.priority  = priority
+        self.callback  = callback
+        self.serial    = serial
+        self.started   = False
+        self.cancelled = False
+        self.result    = None
+        self.error     = None
+        self.qtime     = time.time()
+        self.stime     = None
+        self.etime     = None
+        self.done      = threading.Event()
+
+    def __repr__(self):
+        return 'wtTask({0},key={1},priority={2})'.format(self.name,self.key,self.priority)
+
+    def elapsed(self):
+        """ Seconds it ran, or has been running """
+        if self.stime is None: return 0
+        return (self.etime or time.time()) - self.stime
+
+    def wait(self,timeout=None):
+        return self.done.wait(timeout)
+
+class wtTaskExecutor():
+    """
+    Runs submitted tasks on a fixed number of worker threads, lowest priority
+    number first.  Tasks with a key are only queued once until they finish.
+    Tasks with the same serial run one at a time in the order submitted.
+    """
+
+    def __init__(self,logger,workers=4):
+        self.logger  = logger
+        self.queue   = queue.PriorityQueue()
+        self.lock    = threading.Lock()
+        self.tasks   = dict()
+        # Tasks waiting for the one before them with the same serial.
+        self.serials = dict()
+        self.seq     = itertools.count()
+        self.threads = list()
+        for i in range(max(1,int(workers))):
+            thread = threading.Thread(target=self._worker,name='wtTask{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self,name,target,args=(),kwargs=None,key=None,priority=PRIORITY_NORMAL,callback=None,serial=None):
+        """
+        Queue target(*args,**kwargs).  If a task with the same key is still
+        queued or running that one is returned instead.  If a task with the
+        same serial is then this one waits for it to finish.
+        callback(task) is called when it's done, check task.error and task.result.
+        """
+        with self.lock:
+            if key is not None and key in self.tasks:
+                self.l_debug('submit','{0} already queued: {1}'.format(name,self.tasks[key]))
+                return self.tasks[key]
+            task = wtTask(name,target,args,kwargs or dict(),key,priority,callback,serial)
+            if key is not None:
+                self.tasks[key] = task
+            if serial is not None and serial in self.serials:
+                self.serials[serial].append(task)
+            else:
+                if serial is not None:
+                    self.serials[serial] = deque()
+                self.queue.put((priority,next(self.seq),task))
+        self.l_debug('submit','{0}'.format(task))
+        return task
+
+    def cancel(self,key):
+        """ Cancel the task for key if it hasn't started yet """
+        with self.lock:
+            task = self.tasks.get(key)
+            if task is None or task.started:
+                return False
+            task.cancelled = True
+            del self.tasks[key]
+        self.l_debug('cancel','{0}'.format(task))
+        return True
+
+    def running(self,key):
+        """ True if the task for key is queued or running """
+        with self.lock:
+            return key in self.tasks
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _worker(self):
+        while True:
+            priority, seq, task = self.queue.get()
+            # Under the lock so cancel() can't return True once we've started it.
+            with self.lock:
+                cancelled = task.cancelled
+                if not cancelled:
+                    task.started = True
+            if cancelled:
+                task.done.set()
+                self._callback(task)
+                self._next_serial(task)
+                continue
+            task.stime   = time.time()
+            try:
+                task.result = task.target(*task.args,**task.kwargs)
+            except Exception as err:
+                self.l_error('_worker','{0} failed: {1}'.format(task,err),exc_info=True)
+                task.error = err
+            task.etime = time.time()
+            with self.lock:
+                if task.key is not None and self.tasks.get(task.key) is task:
+                    del self.tasks[task.key]
+            task.done.set()
+            self.l_debug('_worker','{0} done in {1:.2f} seconds, waited {2:.2f}'.format(task,task.elapsed(),task.stime - task.qtime))
+            self._callback(task)
+            # After the callback, so it's done with this result before the next starts.
+            self._next_serial(task)
+
+    def _next_serial(self,task):
+        """ Queue the task waiting for this one, if there is one """
+        if task.serial is None: return
+        with self.lock:
+            waiting = self.serials[task.serial]
+            if len(waiting) == 0:
+                del self.serials[task.serial]
+                return
+            task = waiting.popleft()
+            self.queue.put((task.priority,next(self.seq),task))
+
+    def _callback(self,task):
+        if task.callback is None: return
+        try:
+            task.callback(task)
+        except Exception as err:
+            self.l_error('_callback','{0} callback failed: {1}'.format(task,err),exc_info=True)
+
+    def l_debug(self, name, string):
+        self.logger.debug("wtTaskExecutor:%s: %s" % (name,string))
+
+    def l_error(self, name, string, exc_info=False):
+        self.logger.error("wtTaskExecutor:%s: %s" % (name,string), exc_info=exc_info)
@@ -0,0 +1,144 @@
+"""
+Latency of the tag events from the Tag Manager to our drivers.
+
+wtHandler stamps each event with the time it was received (_rtime in the
+params), wtController.get_handler starts a trace when it dispatches it and
+wTag.setDriver marks the first driver it set.  That gives three rolling
+histograms:
+  cloud     event ts to receipt, how long the cloud took to call us
+  dispatch  receipt to dispatch, waiting on the lock or the worker queue
+  process   receipt to the first setDriver, our total time
+With trace on every event gets an id that is in its log lines, so a slow
+one can be followed through.
+"""
+import time,threading,calendar
+from contextlib import contextmanager
+
+# Upper bounds of the buckets in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000, 300000, float('inf'))
+
+HISTOGRAMS = ('cloud', 'dispatch', 'process')
+
+current = threading.local()
+
+def parse_ts(ts):
+    """ Seconds since the epoch for an event ts like 2018-03-04T20:46:18+00:00, None if it isn't one """
+    try:
+        ts = str(ts).strip()
+        secs = calendar.timegm(time.strptime(ts[:19],'%Y-%m-%dT%H:%M:%S'))
+        offset = ts[19:].replace(' ','+')
+        if len(offset) == 6 and offset[0] in '+-':
+            mins = int(offset[1:3]) * 60 + int(offset[4:6])
+            secs -= mins * 60 if offset[0] == '+' else -mins * 60
+        return secs
+    except (TypeError, ValueError):
+        return None
+
+class wtHistogram():
+    """
+    Counts per bucket for the last window to 2*window seconds, the current
+    window and the one before it.
+    """
+
+    def __init__(self,window=3600):
+        self.window   = window
+        self.start    = time.time()
+        self.counts   = [0] * len(BUCKETS)
+        self.previous = [0] * len(BUCKETS)
+        self.max      = 0.0
+        self.prev_max = 0.0
+
+    def add(self,ms,now=None):
+        now = time.time() if now is None else now
+        if now - self.start >= self.window:
+            # Skipped a whole window then the previous one is empty too.
+            if now - self.start >= 2 * self.window:
+                self.previous = [0] * len(BUCKETS)
+                self.prev_max = 0.0
+            else:
+                self.previous = self.counts
+                self.prev_max = self.max
+            self.counts = [0] * len(BUCKETS)
+            self.max    = 0.0
+            self.start  = now
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.max = max(self.max,ms)
+
+    def get_stats(self):
+        """ { count, p50, p95, p99, max } the percentiles are the bucket bound in ms """
+        counts = [a + b for a, b in zip(self.counts,self.previous)]
+        total  = sum(counts)
+        stats  = { 'count': total, 'max': round(max(self.max,self.prev_max),1) }
+        for name, pct in (('p50',0.50), ('p95',0.95), ('p99',0.99)):
+            stats[name] = None
+            if total == 0: continue
+            need = pct * total
+            cnt  = 0
+            for i, bound in enumerate(BUCKETS):
+                cnt += counts[i]
+                if cnt >= need:
+                    stats[name] = bound
+                    break
+        return stats
+
+class wtLatency():
+
+    def __init__(self,logger,trace=False,window=3600):
+        self.logger     = logger
+        self.trace      = trace
+        self.lock       = threading.Lock()
+        self.next_id    = 0
+        self.histograms = dict((name, wtHistogram(window)) for name in HISTOGRAMS)
+
+    def add(self,name,seconds,now=None):
+        with self.lock:
+            self.histograms[name].add(seconds * 1000.0,now)
+
+    def start(self,command,params):
+        """ Start the trace for an event being dispatched, returns it """
+        now   = time.time()
+        rtime = params.get('_rtime',now)
+        with self.lock:
+            self.next_id += 1
+            trace = { 'id': self.next_id, 'command': command, 'rtime': rtime, 'set': False }
+        ts = parse_ts(params.get('ts'))
+        if ts is not None:
+            # ts only has seconds, and the clocks aren't the same, so this is rough.
+            self.add('cloud',max(rtime - ts,0),now)
+        self.add('dispatch',now - rtime,now)
+        if self.trace:
+            self.l_info('start','trace={0} {1} tmgr_mac={2} tagid={3} ts={4} received +{5:.1f}ms dispatch'.format(
+                trace['id'],command,params.get('tmgr_mac'),params.get('tagid'),params.get('ts'),(now - rtime) * 1000))
+        return trace
+
+    @contextmanager
+    def tracing(self,command,params):
+        """ Context for handling an event, setDriver calls in it are part of the trace """
+        prev = getattr(current,'trace',None)
+        current.trace = self.start(command,params)
+        try:
+            yield current.trace
+        finally:
+            current.trace = prev
+
+    def driver_set(self,address,driver,value):
+        trace = getattr(current,'trace',None)
+        if trace is None:
+            return
+        now = time.time()
+        if not trace['set']:
+            trace['set'] = True
+            self.add('process',now - trace['rtime'],now)
+        if self.trace:
+            self.l_info('driver_set','trace={0} {1} {2}={3} +{4:.1f}ms'.format(
+                trace['id'],address,driver,value,(now - trace['rtime']) * 1000))
+
+    def get_stats(self):
+        with self.lock:
+            return dict((name, hist.get_stats()) for name, hist in self.histograms.items())
+
+    def l_info(self, name, string):
+        self.logger.info("wtLatency:%s: %s" %  (name,string))